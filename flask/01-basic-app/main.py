@@ -44,7 +44,8 @@ if __name__ == "__main__":
   )
 
   ### OPTION 3: Production- or cloud-ready server
-  # Start a Gunicorn server, which is appropriate for use in production or a
-  # cloud deployment.
-  # server_port = os.environ.get("PORT", "8080")
-  # app.run(debug=True, port=server_port, host="0.0.0.0")
+  # Don't run this file; start a Gunicorn server instead, which is appropriate
+  # for use in production or a cloud deployment. It imports the same app
+  # object from wsgi.py:
+  #
+  #   gunicorn --workers 4 --preload --bind 0.0.0.0:8080 wsgi:app
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""WSGI entry point for production servers such as Gunicorn.
+
+Exposes the Flask app object without starting the development server, e.g.:
+
+  gunicorn --workers 4 --preload --bind 0.0.0.0:8080 wsgi:app"""
+
+from webapp import app
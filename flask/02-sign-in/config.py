@@ -31,3 +31,11 @@ class Config(object):
   SESSION_COOKIE_SECURE = True
   SESSION_COOKIE_HTTPONLY = True
   SESSION_COOKIE_SAMESITE = "None"
+
+  # Let browsers cache static files (styles, scripts and images) for 12 hours
+  # instead of revalidating them on every page load. The file names aren't
+  # versioned, so a longer lifetime would delay style and script updates.
+  SEND_FILE_MAX_AGE_DEFAULT = 12 * 60 * 60
+
+  # Prefer Brotli over gzip when compressing responses with Flask-Compress.
+  COMPRESS_ALGORITHM = ["br", "gzip"]
@@ -17,9 +17,32 @@
 Starts the flask server and loads the config."""
 
 from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+from flask_compress import Compress
 import config
+import hashlib
+import jinja2
+
+
+class SessionInterface(SecureCookieSessionInterface):
+  """Signs the session cookie with HMAC-SHA256 rather than HMAC-SHA1."""
+
+  digest_method = staticmethod(hashlib.sha256)
+
 
 app = Flask(__name__)
 app.config.from_object(config.Config)
+app.session_interface = SessionInterface()
+
+# Compress responses for clients that accept Brotli or gzip.
+Compress(app)
+
+# Persist compiled templates on disk so that new worker processes don't have to
+# compile them again.
+app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache()
 
 from webapp import routes
+
+# Load every template once at startup instead of on its first request.
+for template_name in app.jinja_env.list_templates():
+  app.jinja_env.get_template(template_name)
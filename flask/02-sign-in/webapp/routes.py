@@ -15,13 +15,16 @@
 """Defines all routes for the Flask server."""
 
 from webapp import app
-import json
+import functools
 import flask
+import orjson
+import pathlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import google.auth.jwt
 import google.oauth2.credentials
-import google_auth_oauthlib.flow
-import googleapiclient.discovery
 
 # This variable specifies the name of a file that contains the OAuth 2.0
 # information for this application, including its client_id and client_secret.
@@ -31,14 +34,26 @@ CLIENT_SECRETS_FILE = "client_secret.json"
 # authenticated user's account and requires requests to use an SSL connection.
 # These scopes should match the scopes in your GCP project's
 # OAuth Consent Screen: https://console.cloud.google.com/apis/credentials/consent
-SCOPES = [
+SCOPES = (
     "openid",
     "https://www.googleapis.com/auth/userinfo.profile",
     "https://www.googleapis.com/auth/userinfo.email",
     "https://www.googleapis.com/auth/classroom.courses.readonly",
     "https://www.googleapis.com/auth/classroom.addons.teacher",
     "https://www.googleapis.com/auth/classroom.addons.student",
-]
+)
+
+# A shared HTTP session for requests made directly to Google's OAuth endpoints.
+# Reusing its connection pool avoids a new TCP and TLS handshake per request.
+_http_session = requests.Session()
+_http_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=100,
+        max_retries=Retry(total=2, backoff_factor=0.1),
+    ),
+)
 
 
 @app.route("/")
@@ -85,34 +100,44 @@ def test_api_request(request_type="username"):
     return start_auth_flow()
 
   # Load credentials from the session.
-  credentials = google.oauth2.credentials.Credentials(
-      **flask.session["credentials"]
-  )
+  credentials = credentials_from_session()
 
   # Create an API client and make an API request.
   fetched_data = ""
 
   if request_type == "username":
     if not flask.session.get("username"):
-      user_info_service = googleapiclient.discovery.build(
-          serviceName="oauth2", version="v2", credentials=credentials
-      )
-
       flask.session["username"] = (
-          user_info_service.userinfo().get().execute().get("name")
+          get_user_info_service().userinfo()
+          .get()
+          .execute(http=authorized_http(credentials))
+          .get("name")
       )
 
     fetched_data = flask.session.get("username")
 
-  # Save credentials back to session in case access token was refreshed.
-  # ACTION ITEM: In a production app, you likely want to save these
+  # Save credentials back to session if the access token was refreshed.
+  # Skipping the write otherwise avoids re-signing and re-sending the session
+  # cookie. ACTION ITEM: In a production app, you likely want to save these
   # credentials in a persistent database instead.
-  flask.session["credentials"] = credentials_to_dict(credentials)
+  if credentials.token != flask.session["credentials"].get("token"):
+    flask.session["credentials"] = credentials_to_dict(credentials)
+
+  # Return the results as-is to clients that ask for JSON.
+  if (
+      flask.request.accept_mimetypes.best_match(
+          ["text/html", "application/json"]
+      )
+      == "application/json"
+  ):
+    return flask.Response(
+        orjson.dumps(fetched_data), mimetype="application/json"
+    )
 
   # Render the results of the API call.
   return flask.render_template(
       "show-api-query-result.html",
-      data=json.dumps(fetched_data, indent=2),
+      data=orjson.dumps(fetched_data, option=orjson.OPT_INDENT_2).decode(),
       data_title=request_type,
   )
 
@@ -123,17 +148,21 @@ def authorize():
   Initializes the OAuth flow and redirects to Google's authorization page.
   """
 
+  # The OAuth client library is imported on first use rather than at startup,
+  # since most requests never start an authorization flow.
+  import google_auth_oauthlib.flow
+
   # Create flow instance to manage the OAuth 2.0 Authorization Grant Flow
   # steps.
-  flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-      CLIENT_SECRETS_FILE, scopes=SCOPES
+  flow = google_auth_oauthlib.flow.Flow.from_client_config(
+      get_client_config(), scopes=SCOPES
   )
 
   # The URI created here must exactly match one of the authorized redirect
   # URIs for the OAuth 2.0 client, which you configured in the API Console. If
   # this value doesn't match an authorized URI, you will get a
   # "redirect_uri_mismatch" error.
-  flow.redirect_uri = flask.url_for("callback", _external=True)
+  flow.redirect_uri = get_callback_url(flask.request.url_root)
 
   authorization_url, state = flow.authorization_url(
       # Enable offline access so that you can refresh an access token without
@@ -159,13 +188,16 @@ def callback():
   """
 
   # Specify the state when creating the flow in the callback so that it can be
-  # verified in the authorization server response.
-  state = flask.session["state"]
+  # verified in the authorization server response. It's only needed once, so
+  # remove it rather than carrying it in the session cookie from now on.
+  state = flask.session.pop("state")
+
+  import google_auth_oauthlib.flow
 
-  flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-      CLIENT_SECRETS_FILE, scopes=SCOPES, state=state
+  flow = google_auth_oauthlib.flow.Flow.from_client_config(
+      get_client_config(), scopes=SCOPES, state=state
   )
-  flow.redirect_uri = flask.url_for("callback", _external=True)
+  flow.redirect_uri = get_callback_url(flask.request.url_root)
 
   # Use the authorization server's response to fetch the OAuth 2.0 tokens.
   authorization_response = flask.request.url
@@ -176,16 +208,16 @@ def callback():
   credentials = flow.credentials
   flask.session["credentials"] = credentials_to_dict(credentials)
 
-  # The flow is complete! We'll use the credentials to fetch the username.
-  user_info_service = googleapiclient.discovery.build(
-      serviceName="oauth2", version="v2", credentials=credentials
-  )
+  # The flow is complete! The token response includes an ID token that
+  # already carries the user's name, so read it from there rather than
+  # issuing another request to the userinfo endpoint. The token came directly
+  # from Google's token endpoint over HTTPS, so per the OpenID Connect spec we
+  # can rely on TLS instead of verifying its signature.
+  id_info = google.auth.jwt.decode(credentials.id_token, verify=False)
 
-  flask.session["username"] = (
-      user_info_service.userinfo().get().execute().get("name")
-  )
+  flask.session["username"] = id_info.get("name")
 
-  return flask.render_template("close-me.html")
+  return render_cached_template("close-me.html")
 
 
 @app.route("/revoke")
@@ -201,11 +233,9 @@ def revoke():
         + "attempting to revoke credentials.",
     )
 
-  credentials = google.oauth2.credentials.Credentials(
-      **flask.session["credentials"]
-  )
+  credentials = credentials_from_session()
 
-  revoke = requests.post(
+  revoke_response = _http_session.post(
       "https://oauth2.googleapis.com/revoke",
       params={"token": credentials.token},
       headers={"content-type": "application/x-www-form-urlencoded"},
@@ -213,8 +243,7 @@ def revoke():
 
   clear_credentials_in_session()
 
-  status_code = getattr(revoke, "status_code")
-  if status_code == 200:
+  if revoke_response.status_code == 200:
     return start_auth_flow()
   else:
     return flask.render_template(
@@ -229,7 +258,7 @@ def start_auth_flow():
   rendered to properly manage popups.
   """
 
-  return flask.render_template("authorization.html")
+  return render_cached_template("authorization.html")
 
 
 @app.route("/clear")
@@ -240,7 +269,7 @@ def clear_credentials():
 
   clear_credentials_in_session()
 
-  return flask.render_template("signed-out.html")
+  return render_cached_template("signed-out.html")
 
 
 def clear_credentials_in_session():
@@ -248,23 +277,113 @@ def clear_credentials_in_session():
   Clears the credentials from the session.
   """
 
-  if "credentials" in flask.session:
-    del flask.session["credentials"]
-    del flask.session["username"]
-
   flask.session.clear()
 
 
 def credentials_to_dict(credentials):
   """
-  Returns a dictionary from a credentials object.
+  Returns a dictionary of the user-specific fields of a credentials object.
+
+  The token URI, client ID, client secret and scopes are the same for every
+  user, so they're left out to keep the session cookie small; see
+  credentials_from_session().
   """
 
   return {
       "token": credentials.token,
       "refresh_token": credentials.refresh_token,
-      "token_uri": credentials.token_uri,
-      "client_id": credentials.client_id,
-      "client_secret": credentials.client_secret,
-      "scopes": credentials.scopes,
   }
+
+
+def credentials_from_session():
+  """
+  Returns a credentials object built from the tokens stored in the session and
+  the client details in the client secrets file.
+  """
+
+  session_credentials = flask.session["credentials"]
+  client_config = get_client_config()["web"]
+
+  return google.oauth2.credentials.Credentials(
+      token=session_credentials.get("token"),
+      refresh_token=session_credentials.get("refresh_token"),
+      token_uri=client_config["token_uri"],
+      client_id=client_config["client_id"],
+      client_secret=client_config["client_secret"],
+      scopes=SCOPES,
+  )
+
+
+@functools.lru_cache(maxsize=16)
+def get_callback_url(url_root):
+  """
+  Returns the external URL of the OAuth callback route. The URL only varies
+  with the root URL the app is served from, so it is built once per root.
+
+  Args:
+      url_root: The root URL of the current request, used as the cache key.
+  """
+
+  return flask.url_for("callback", _external=True)
+
+
+@functools.lru_cache(maxsize=None)
+def get_client_config():
+  """
+  Returns the parsed contents of the client secrets file. The file is only
+  read once per process.
+  """
+
+  return orjson.loads(pathlib.Path(CLIENT_SECRETS_FILE).read_bytes())
+
+
+@functools.lru_cache(maxsize=None)
+def render_cached_template(template_name, **context):
+  """
+  Renders a template whose output depends only on its arguments, not on the
+  request or session. Each distinct page is rendered once per process and the
+  resulting HTML is reused for every later request, so this must not be used
+  for templates that include "navbar.html", which shows the signed-in user.
+
+  Args:
+      template_name: The name of the template to render.
+      context: Hashable values to pass to the template.
+  """
+
+  return flask.render_template(template_name, **context)
+
+
+@functools.lru_cache(maxsize=None)
+def get_user_info_service():
+  """
+  Returns an OAuth2 API client, built once per process from the discovery
+  document bundled with the client library. It holds no credentials of its
+  own; each request is authorized for the current user with authorized_http().
+  The client libraries are imported on first use so that worker startup, and
+  routes that never call the API, don't pay for loading them.
+  """
+
+  import googleapiclient.discovery
+  import googleapiclient.http
+
+  return googleapiclient.discovery.build(
+      serviceName="oauth2",
+      version="v2",
+      http=googleapiclient.http.build_http(),
+      static_discovery=True,
+  )
+
+
+def authorized_http(credentials):
+  """
+  Returns an HTTP client that authorizes requests with the given credentials,
+  refreshing the access token if needed. Pass it to execute() on requests
+  made with a shared service object such as get_user_info_service().
+  """
+
+  import google_auth_httplib2
+  import googleapiclient.http
+
+  return google_auth_httplib2.AuthorizedHttp(
+      credentials, http=googleapiclient.http.build_http()
+  )
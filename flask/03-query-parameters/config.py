@@ -14,7 +14,16 @@
 # the License.
 """The Flask server configuration."""
 
+from datetime import timedelta
 import os
+from sqlalchemy.pool import QueuePool
+
+# If set, store session data in this Redis instance instead of the database,
+# e.g. "redis://localhost:6379/0".
+REDIS_URL = os.environ.get("REDIS_URL")
+
+if REDIS_URL:
+  import redis
 
 DATABASE_FILE_NAME = os.path.join(
     os.path.abspath(os.path.dirname(__file__)), "data.sqlite"
@@ -36,6 +45,44 @@ class Config(object):
   SESSION_COOKIE_HTTPONLY = True
   SESSION_COOKIE_SAMESITE = "None"
 
+  # Store session data server-side with Flask-Session, so the cookie only holds
+  # a signed session ID rather than the user's tokens. Sessions are kept in the
+  # same database as the users unless REDIS_URL is set; Redis keeps them in
+  # memory and can be shared by several hosts.
+  SESSION_USE_SIGNER = True
+  if REDIS_URL:
+    SESSION_TYPE = "redis"
+    SESSION_REDIS = redis.Redis(
+        connection_pool=redis.BlockingConnectionPool.from_url(
+            REDIS_URL, max_connections=50
+        )
+    )
+  else:
+    SESSION_TYPE = "sqlalchemy"
+
+  # A Fernet key, e.g. from Fernet.generate_key(), used to encrypt session data
+  # stored in Redis. Required when REDIS_URL is set.
+  SESSION_ENCRYPTION_KEY = os.environ.get("SESSION_ENCRYPTION_KEY")
+
+  # Stored sessions expire after this long, which Redis enforces with a TTL on
+  # each session key. The database backend needs an expiry on every session
+  # row, so sessions are left permanent. Access tokens only last an hour, and the add-on iframe
+  # signs the user back in from the login_hint query parameter.
+  PERMANENT_SESSION_LIFETIME = timedelta(hours=12)
+
   # Point to a database file in the project root.
   SQLALCHEMY_DATABASE_URI = f"sqlite:///{DATABASE_FILE_NAME}"
   SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+  # Keep a pool of open database connections rather than opening a new one for
+  # every request, which is SQLAlchemy's default for SQLite files. Connections
+  # are shared between threads, so SQLite's same-thread check is disabled. A
+  # write waits up to 30 seconds for another connection's lock to be released
+  # instead of failing with "database is locked".
+  SQLALCHEMY_ENGINE_OPTIONS = {
+      "poolclass": QueuePool,
+      "pool_size": 10,
+      "max_overflow": 20,
+      "pool_pre_ping": True,
+      "connect_args": {"check_same_thread": False, "timeout": 30},
+  }
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Gunicorn configuration for the Flask server.
+
+Most request time is spent waiting on Google's OAuth and API endpoints, so each
+worker process runs several threads: a request blocked on the network doesn't
+hold up the others. Threads rather than gevent greenlets are used because
+SQLite calls block in C and would stall every greenlet in the worker."""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+
+# Create the database tables once in the master process rather than racing to
+# create them in every worker.
+preload_app = True
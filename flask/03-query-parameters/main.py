@@ -64,7 +64,9 @@ if __name__ == "__main__":
   )
 
   ### OPTION 3: Production- or cloud-ready server
-  # Start a Gunicorn server, which is appropriate for use in production or a
-  # cloud deployment.
-  # server_port = os.environ.get("PORT", "8080")
-  # app.run(debug=True, port=server_port, host="0.0.0.0")
+  # Don't run this file; start a Gunicorn server instead, which is appropriate
+  # for use in production or a cloud deployment. The settings in
+  # gunicorn.conf.py run two workers of 16 threads each and listen on $PORT
+  # (default 8080):
+  #
+  #   gunicorn -c gunicorn.conf.py wsgi:app
@@ -16,18 +16,87 @@
 
 Starts the flask server, loads the config, and initializes the database."""
 
+from cryptography.fernet import Fernet
 from flask import Flask
 import config
+from flask_session import Session
 from flask_sqlalchemy import SQLAlchemy
-from os import path
+import msgpack
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sqlite3
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = Flask(__name__)
 app.config.from_object(config.Config)
 
+# Trust the X-Forwarded-* headers set by one reverse proxy in front of the app,
+# so that redirect URIs built with url_for(_external=True) use the public
+# https scheme and host rather than those of the proxy's plain HTTP hop.
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
+
 db = SQLAlchemy(app)
 
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+  """Configures each new SQLite connection for concurrent access.
+
+  Write-ahead logging lets readers proceed while a write is in progress, and
+  synchronous=NORMAL is safe in WAL mode while syncing to disk far less often.
+  """
+  if not isinstance(dbapi_connection, sqlite3.Connection):
+    return
+
+  cursor = dbapi_connection.cursor()
+  cursor.execute("PRAGMA journal_mode=WAL")
+  cursor.execute("PRAGMA synchronous=NORMAL")
+  cursor.execute("PRAGMA temp_store=MEMORY")
+  cursor.execute("PRAGMA mmap_size=268435456")
+  # Keep up to 20 MB of recently used pages in each connection's cache.
+  cursor.execute("PRAGMA cache_size=-20000")
+  cursor.close()
+
+
+class EncryptedSessionSerializer(object):
+  """Serializes session data with msgpack and encrypts it with Fernet.
+
+  Used for session stores outside the app, such as Redis, so that the access
+  token in the session isn't readable by anyone with access to the store.
+  """
+
+  def __init__(self, key):
+    self._fernet = Fernet(key)
+
+  def dumps(self, data):
+    return self._fernet.encrypt(msgpack.packb(data))
+
+  def loads(self, data):
+    return msgpack.unpackb(self._fernet.decrypt(data))
+
+
 from webapp import routes, models
 
-# Initialize the database file if not created.
-if not path.exists(config.DATABASE_FILE_NAME):
-  db.create_all()
+# Keep session data in the database; the cookie only carries the session ID.
+app.config["SESSION_SQLALCHEMY"] = db
+Session(app)
+
+# Encrypt sessions kept in Redis. Refusing to start without a key means
+# sessions are never stored there unencrypted by mistake.
+if app.config["SESSION_TYPE"] == "redis":
+  if not app.config["SESSION_ENCRYPTION_KEY"]:
+    raise RuntimeError(
+        "SESSION_ENCRYPTION_KEY must be set when REDIS_URL is set."
+    )
+
+  app.session_interface.serializer = EncryptedSessionSerializer(
+      app.config["SESSION_ENCRYPTION_KEY"]
+  )
+
+# Create any tables that don't exist yet, including the sessions table.
+db.create_all()
+
+# Close the connections opened above. With preload_app, this module is
+# imported in the Gunicorn master, and SQLite connections must not be shared
+# with the forked workers; each worker opens its own instead.
+db.engine.dispose()
@@ -16,16 +16,25 @@
 
 Uses the flask-sqlalchemy database object defined in the webapp module."""
 
+from sqlalchemy.orm import deferred
 from webapp import db
 
 
 # Database model to represent a user.
 class User(db.Model):
+  # Store rows directly in the primary key's B-tree. Users are always looked up
+  # by their string ID, which would otherwise go through a separate index to
+  # find the rowid. This only applies when the table is created; delete an
+  # existing data.sqlite file to recreate it.
+  __table_args__ = {"sqlite_with_rowid": False}
+
   # The user's identifying information:
   id = db.Column(db.String(120), primary_key=True)
   display_name = db.Column(db.String(80))
-  email = db.Column(db.String(120), unique=True)
-  portrait_url = db.Column(db.Text())
+  email = db.Column(db.String(120), unique=True, index=True)
+  # The portrait URL is loaded only when accessed, since it's long and rarely
+  # needed.
+  portrait_url = deferred(db.Column(db.Text()))
 
   # The user's refresh token, which will be used to obtain an access token.
   # Note that refresh tokens will become invalid if:
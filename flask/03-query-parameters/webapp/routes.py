@@ -17,13 +17,25 @@
 from webapp import app
 from webapp.models import User
 from webapp import db
-import json
+import cachetools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import Fernet, InvalidToken
+import datetime
+import functools
 import flask
+import orjson
+import pathlib
 import requests
-
+from requests.adapters import HTTPAdapter
+import sqlalchemy
+from sqlalchemy.dialects import sqlite
+import threading
+from urllib3.util.retry import Retry
+
+import google.auth.jwt
+import google.auth.transport.requests
 import google.oauth2.credentials
-import google_auth_oauthlib.flow
-import googleapiclient.discovery
 
 # This variable specifies the name of a file that contains the OAuth 2.0
 # information for this application, including its client_id and client_secret.
@@ -33,14 +45,59 @@ CLIENT_SECRETS_FILE = "client_secret.json"
 # authenticated user's account and requires requests to use an SSL connection.
 # These scopes should match the scopes in your GCP project's
 # OAuth Consent Screen: https://console.cloud.google.com/apis/credentials/consent
-SCOPES = [
+SCOPES = (
     "openid",
     "https://www.googleapis.com/auth/userinfo.profile",
     "https://www.googleapis.com/auth/userinfo.email",
     "https://www.googleapis.com/auth/classroom.courses.readonly",
     "https://www.googleapis.com/auth/classroom.addons.teacher",
     "https://www.googleapis.com/auth/classroom.addons.student",
-]
+)
+
+# The fields of a stored User record needed to load their credentials.
+StoredCredentials = collections.namedtuple(
+    "StoredCredentials", ["id", "display_name", "refresh_token"]
+)
+
+# Recently read stored credentials, keyed by user ID, so that repeated iframe
+# loads by the same user don't query the database each time. Entries expire
+# after a minute so that changes made by other worker processes are seen.
+STORED_CREDENTIALS_TTL = 60
+_stored_credentials_cache = cachetools.TTLCache(
+    maxsize=1024, ttl=STORED_CREDENTIALS_TTL
+)
+_stored_credentials_cache_lock = threading.Lock()
+
+# Marks a missing entry in _stored_credentials_cache, whose values can be None.
+_NOT_CACHED = object()
+
+# Runs database writes that the response doesn't depend on, so that the
+# response isn't held up waiting for the commit.
+_background_writer = ThreadPoolExecutor(max_workers=4)
+
+# A shared HTTP session for requests made directly to Google's OAuth endpoints.
+# Reusing its connection pool avoids a new TCP and TLS handshake per request.
+_http_session = requests.Session()
+_http_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=100,
+        max_retries=Retry(total=2, backoff_factor=0.1),
+    ),
+)
+
+# One lock per user ID, held while refreshing that user's access token so that
+# concurrent requests for the same user post the refresh token only once.
+# Locks of users who haven't refreshed recently are dropped, so the map stays
+# bounded; a refresh takes seconds, far less than the TTL.
+_refresh_locks = cachetools.TTLCache(maxsize=1024, ttl=10 * 60)
+_refresh_locks_lock = threading.Lock()
+
+# The access token and expiry most recently obtained for each user ID, so that
+# requests waiting on a refresh lock can reuse the token it produced.
+_refreshed_tokens = cachetools.TTLCache(maxsize=1024, ttl=60 * 60)
+_refreshed_tokens_lock = threading.Lock()
 
 
 @app.route("/")
@@ -88,43 +145,24 @@ def classroom_addon():
     return start_auth_flow()
 
   # Check if we have any stored credentials for this user.
-  stored_credentials = get_credentials_from_storage(login_hint)
-
-  # If we have stored credentials, load them into the session.
-  if stored_credentials:
-    # Load the client secrets file contents.
-    client_secrets_dict = json.load(open(CLIENT_SECRETS_FILE)).get("web")
-
-    # Update the credentials in the session.
-    if not flask.session.get("credentials"):
-      flask.session["credentials"] = {}
-
-    flask.session["credentials"]["token"] = (
-        flask.session.get("credentials").get("token") or None
-    )
-    flask.session["credentials"][
-        "refresh_token"
-    ] = stored_credentials.refresh_token
-    flask.session["credentials"]["token_uri"] = client_secrets_dict["token_uri"]
-    flask.session["credentials"]["client_id"] = client_secrets_dict["client_id"]
-    flask.session["credentials"]["client_secret"] = client_secrets_dict[
-        "client_secret"
-    ]
-    flask.session["credentials"]["scopes"] = SCOPES
-
-    # Set the username and login_hint in the session.
-    flask.session["username"] = stored_credentials.display_name
-    flask.session["login_hint"] = stored_credentials.id
+  stored_credentials = get_cached_credentials_from_storage(login_hint)
 
   # Redirect to the authorization page if we received login_hint but don't
   # have any stored credentials for this user. We need the refresh token
   # specifically.
-  if (
-      "credentials" not in flask.session
-      or flask.session["credentials"]["refresh_token"] is None
-  ):
+  if stored_credentials is None or stored_credentials.refresh_token is None:
     return start_auth_flow()
 
+  # The session only keeps the access token, if we have one yet; the rest of
+  # the credentials are loaded from storage when needed. See
+  # credentials_from_session().
+  if "credentials" not in flask.session:
+    flask.session["credentials"] = {"token": None}
+
+  # Set the username and login_hint in the session.
+  flask.session["username"] = stored_credentials.display_name
+  flask.session["login_hint"] = stored_credentials.id
+
   return flask.render_template(
       "addon-discovery.html", message="You've reached the addon discovery page."
   )
@@ -139,37 +177,36 @@ def test_api_request(request_type="username"):
       request_type: The type of API request to test. Currently only "username" is supported.
   """
 
-  if "credentials" not in flask.session:
+  # Load the access token from the session, the refresh token from storage,
+  # and the client id and client secret from file.
+  credentials = credentials_from_session()
+  if credentials is None:
     return start_auth_flow()
 
-  # Load credentials from the session and client id and client secret from file.
-  credentials = google.oauth2.credentials.Credentials(
-      **flask.session["credentials"]
-  )
-
   # Create an API client and make an API request.
   fetched_data = ""
 
   if request_type == "username":
-    # if not flask.session.get("username"):
-    user_info_service = googleapiclient.discovery.build(
-        serviceName="oauth2", version="v2", credentials=credentials
-    )
-
-    flask.session["username"] = (
-        user_info_service.userinfo().get().execute().get("name")
-    )
+    if not flask.session.get("username"):
+      flask.session["username"] = (
+          get_user_info_service().userinfo()
+          .get()
+          .execute(http=authorized_http(credentials))
+          .get("name")
+      )
 
     fetched_data = flask.session.get("username")
 
-  # Save credentials in case access token was refreshed.
-  flask.session["credentials"] = credentials_to_dict(credentials)
-  save_user_credentials(credentials)
+  # Save credentials if the access token was refreshed. Skipping the writes
+  # otherwise avoids a database update and re-sending the session cookie.
+  if credentials.token != flask.session["credentials"].get("token"):
+    flask.session["credentials"] = credentials_to_dict(credentials)
+    save_user_credentials_in_background(credentials)
 
   # Render the results of the API call.
   return flask.render_template(
       "show-api-query-result.html",
-      data=json.dumps(fetched_data, indent=2),
+      data=orjson.dumps(fetched_data, option=orjson.OPT_INDENT_2).decode(),
       data_title=request_type,
   )
 
@@ -180,9 +217,13 @@ def authorize():
   Initializes the OAuth flow and redirects to Google's authorization page.
   """
 
+  # The OAuth client library is imported on first use rather than at startup,
+  # since most requests never start an authorization flow.
+  import google_auth_oauthlib.flow
+
   # Create flow instance to manage the OAuth 2.0 Authorization Grant Flow steps.
-  flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-      CLIENT_SECRETS_FILE,
+  flow = google_auth_oauthlib.flow.Flow.from_client_config(
+      get_client_config(),
       scopes=SCOPES,
   )
 
@@ -220,8 +261,10 @@ def callback():
   # verified in the authorization server response.
   state = flask.session["state"]
 
-  flow = google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-      CLIENT_SECRETS_FILE, scopes=SCOPES, state=state
+  import google_auth_oauthlib.flow
+
+  flow = google_auth_oauthlib.flow.Flow.from_client_config(
+      get_client_config(), scopes=SCOPES, state=state
   )
   flow.redirect_uri = flask.url_for("callback", _external=True)
 
@@ -233,14 +276,15 @@ def callback():
   credentials = flow.credentials
   flask.session["credentials"] = credentials_to_dict(credentials)
 
-  # The flow is complete! We'll use the credentials to fetch the user's info.
-  user_info_service = googleapiclient.discovery.build(
-      serviceName="oauth2", version="v2", credentials=credentials
-  )
-
-  user_info = user_info_service.userinfo().get().execute()
+  # The flow is complete! The token response includes an ID token that
+  # already carries the user's profile, so read it from there rather than
+  # issuing another request to the userinfo endpoint. The token came directly
+  # from Google's token endpoint over HTTPS, so per the OpenID Connect spec we
+  # can rely on TLS instead of verifying its signature.
+  user_info = id_token_to_user_info(credentials.id_token)
 
   flask.session["username"] = user_info.get("name")
+  flask.session["login_hint"] = user_info.get("id")
 
   # Add the credentials to our persistent storage.
   # We'll extract the "id" value from the credentials to use as a key.
@@ -252,7 +296,7 @@ def callback():
   # update the stored credentials.
   save_user_credentials(credentials, user_info)
 
-  return flask.render_template("close-me.html")
+  return render_cached_template("close-me.html")
 
 
 @app.route("/revoke")
@@ -261,18 +305,16 @@ def revoke():
   Revokes the logged in user's credentials.
   """
 
-  if "credentials" not in flask.session:
+  credentials = credentials_from_session()
+
+  if credentials is None:
     return flask.render_template(
         "addon-discovery.html",
         message="You need to authorize before "
         + "attempting to revoke credentials.",
     )
 
-  credentials = google.oauth2.credentials.Credentials(
-      **flask.session["credentials"]
-  )
-
-  revoke = requests.post(
+  revoke_response = _http_session.post(
       "https://oauth2.googleapis.com/revoke",
       params={"token": credentials.token},
       headers={"content-type": "application/x-www-form-urlencoded"},
@@ -280,8 +322,7 @@ def revoke():
 
   clear_credentials_in_session()
 
-  status_code = getattr(revoke, "status_code")
-  if status_code == 200:
+  if revoke_response.status_code == 200:
     return start_auth_flow()
   else:
     return flask.render_template(
@@ -296,7 +337,7 @@ def start_auth_flow():
   template be rendered to properly manage popups.
   """
 
-  return flask.render_template("authorization.html")
+  return render_cached_template("authorization.html")
 
 
 @app.route("/clear")
@@ -307,7 +348,7 @@ def clear_credentials():
 
   clear_credentials_in_session()
 
-  return flask.render_template("signed-out.html")
+  return render_cached_template("signed-out.html")
 
 
 def clear_credentials_in_session():
@@ -315,64 +356,353 @@ def clear_credentials_in_session():
   Clears the credentials from the session.
   """
 
-  if "credentials" in flask.session:
-    del flask.session["credentials"]
-    del flask.session["username"]
+  flask.session.pop("credentials", None)
+  flask.session.pop("username", None)
 
 
 def credentials_to_dict(credentials):
   """
-  Returns a dictionary from a credentials object.
+  Returns the part of a credentials object that is kept in the session: the
+  short-lived access token and when it expires. The refresh token is kept in
+  storage instead.
   """
 
   return {
       "token": credentials.token,
-      "refresh_token": credentials.refresh_token,
-      "token_uri": credentials.token_uri,
-      "client_id": credentials.client_id,
-      "client_secret": credentials.client_secret,
-      "scopes": credentials.scopes,
+      "expiry": credentials.expiry.isoformat() if credentials.expiry else None,
+  }
+
+
+def credentials_from_session():
+  """
+  Returns a credentials object for the signed-in user, combining the access
+  token from the session, the refresh token from storage and the client
+  details from the client secrets file. Returns None if the user isn't signed
+  in or has no stored credentials.
+  """
+
+  if "credentials" not in flask.session or not flask.session.get("login_hint"):
+    return None
+
+  stored_credentials = get_cached_credentials_from_storage(
+      flask.session["login_hint"]
+  )
+  if stored_credentials is None:
+    return None
+
+  client_config = get_client_config()["web"]
+
+  # Without its expiry, a token can't be known to be valid, so it's refreshed
+  # here, under the user's refresh lock, rather than by the first API call
+  # that's rejected.
+  expiry = flask.session["credentials"].get("expiry")
+
+  credentials = google.oauth2.credentials.Credentials(
+      token=flask.session["credentials"].get("token") if expiry else None,
+      expiry=datetime.datetime.fromisoformat(expiry) if expiry else None,
+      refresh_token=stored_credentials.refresh_token,
+      token_uri=client_config["token_uri"],
+      client_id=client_config["client_id"],
+      client_secret=client_config["client_secret"],
+      scopes=SCOPES,
+  )
+
+  if not credentials.valid:
+    refresh_credentials(credentials, stored_credentials.id)
+
+  return credentials
+
+
+def refresh_credentials(credentials, id):
+  """
+  Refreshes the access token of a credentials object, at most once at a time
+  per user. A request that waited for another request's refresh of the same
+  user's token reuses that token if it is still valid.
+
+  Args:
+      credentials: A Credentials object with a refresh token.
+      id: The ID of the user the credentials belong to.
+  """
+
+  with _refresh_locks_lock:
+    refresh_lock = _refresh_locks.get(id)
+    if refresh_lock is None:
+      refresh_lock = _refresh_locks[id] = threading.Lock()
+
+  with refresh_lock:
+    with _refreshed_tokens_lock:
+      refreshed_token = _refreshed_tokens.get(id)
+    if refreshed_token is not None:
+      credentials.token, credentials.expiry = refreshed_token
+
+    if not credentials.valid:
+      credentials.refresh(
+          google.auth.transport.requests.Request(session=_http_session)
+      )
+      with _refreshed_tokens_lock:
+        _refreshed_tokens[id] = (credentials.token, credentials.expiry)
+
+
+@functools.lru_cache(maxsize=None)
+def render_cached_template(template_name, **context):
+  """
+  Renders a template whose output depends only on its arguments, not on the
+  request or session. Each distinct page is rendered once per process and the
+  resulting HTML is reused for every later request, so this must not be used
+  for templates that include "navbar.html", which shows the signed-in user.
+
+  Args:
+      template_name: The name of the template to render.
+      context: Hashable values to pass to the template.
+  """
+
+  return flask.render_template(template_name, **context)
+
+
+@functools.lru_cache(maxsize=None)
+def get_client_config():
+  """
+  Returns the parsed contents of the client secrets file. The file is only
+  read once per process.
+  """
+
+  return orjson.loads(pathlib.Path(CLIENT_SECRETS_FILE).read_bytes())
+
+
+@functools.lru_cache(maxsize=None)
+def get_user_info_service():
+  """
+  Returns an OAuth2 API client, built once per process from the discovery
+  document bundled with the client library. It holds no credentials of its
+  own; each request is authorized for the current user with authorized_http().
+  The client libraries are imported on first use so that worker startup, and
+  routes that never call the API, don't pay for loading them.
+  """
+
+  import googleapiclient.discovery
+  import googleapiclient.http
+
+  return googleapiclient.discovery.build(
+      serviceName="oauth2",
+      version="v2",
+      http=googleapiclient.http.build_http(),
+      static_discovery=True,
+  )
+
+
+def authorized_http(credentials):
+  """
+  Returns an HTTP client that authorizes requests with the given credentials,
+  refreshing the access token if needed. Pass it to execute() on requests
+  made with a shared service object such as get_user_info_service().
+  """
+
+  import google_auth_httplib2
+  import googleapiclient.http
+
+  return google_auth_httplib2.AuthorizedHttp(
+      credentials, http=googleapiclient.http.build_http()
+  )
+
+
+def id_token_to_user_info(id_token):
+  """
+  Returns a dictionary in the format of an OAuth2 API userinfo response,
+  populated from the claims in an ID token.
+
+  Args:
+      id_token: An encoded ID token returned by the OAuth 2.0 token endpoint.
+  """
+
+  claims = google.auth.jwt.decode(id_token, verify=False)
+
+  return {
+      "id": claims.get("sub"),
+      "name": claims.get("name"),
+      "email": claims.get("email"),
+      "picture": claims.get("picture"),
   }
 
 
 def get_credentials_from_storage(id):
   """
-  Retrieves credentials from the storage and returns them as a dictionary.
+  Retrieves credentials from the storage and returns them as a
+  StoredCredentials tuple, or None if there is no record for the user. Only
+  the needed columns are selected, without loading a full User object.
+  """
+  row = db.session.execute(
+      sqlalchemy.select(User.id, User.display_name, User.refresh_token).where(
+          User.id == id
+      )
+  ).first()
+
+  return StoredCredentials(*row) if row else None
+
+
+def get_cached_credentials_from_storage(id):
+  """
+  Retrieves the stored credentials for a user, reading from the database only
+  if they aren't cached. If sessions are stored in Redis, the cache is kept
+  there too, so that every worker process sees an update as soon as it's
+  saved. Otherwise an in-process cache is used.
+
+  Args:
+      id: The user ID, typically passed in the login_hint query parameter.
+  Returns:
+      A StoredCredentials tuple, or None if there is no record for the user.
+  """
+
+  shared_cache = app.config.get("SESSION_REDIS")
+
+  if shared_cache is None:
+    # A user without a record is cached as None, so look the key up with a
+    # sentinel rather than testing the value.
+    with _stored_credentials_cache_lock:
+      stored_credentials = _stored_credentials_cache.get(id, _NOT_CACHED)
+    if stored_credentials is not _NOT_CACHED:
+      return stored_credentials
+
+    stored_credentials = get_credentials_from_storage(id)
+    with _stored_credentials_cache_lock:
+      _stored_credentials_cache[id] = stored_credentials
+
+    return stored_credentials
+
+  # The cached record includes the user's refresh token, so it's encrypted
+  # with the same key as the sessions kept in Redis.
+  fernet = get_shared_cache_fernet()
+
+  cached = shared_cache.get(f"user:{id}")
+  if cached is not None:
+    try:
+      fields = orjson.loads(fernet.decrypt(cached))
+    except InvalidToken:
+      # Written before the key changed; read the database instead.
+      pass
+    else:
+      return StoredCredentials(*fields) if fields else None
+
+  stored_credentials = get_credentials_from_storage(id)
+  shared_cache.setex(
+      f"user:{id}",
+      STORED_CREDENTIALS_TTL,
+      fernet.encrypt(
+          orjson.dumps(list(stored_credentials) if stored_credentials else None)
+      ),
+  )
+
+  return stored_credentials
+
+
+@functools.lru_cache(maxsize=None)
+def get_shared_cache_fernet():
+  """
+  Returns the Fernet instance that encrypts values kept in Redis, built once
+  per process from the SESSION_ENCRYPTION_KEY setting.
+  """
+
+  return Fernet(app.config["SESSION_ENCRYPTION_KEY"])
+
+
+def forget_cached_credentials(*ids):
+  """
+  Drops any cached copies of the stored credentials for the given user IDs.
   """
-  return User.query.get(id)
+
+  shared_cache = app.config.get("SESSION_REDIS")
+
+  for id in ids:
+    if id is None:
+      continue
+    if shared_cache is None:
+      with _stored_credentials_cache_lock:
+        _stored_credentials_cache.pop(id, None)
+    else:
+      shared_cache.delete(f"user:{id}")
 
 
-def save_user_credentials(credentials=None, user_info=None):
+def save_user_credentials(credentials=None, user_info=None, id=None):
   """
-  Updates or adds a User to the database. A new user is added only if both
-  credentials and user_info are provided.
+  Updates or adds a User to the database with a single statement. A user is
+  added or has their profile updated only if user_info is provided; otherwise
+  only the stored refresh token of the signed-in user is updated.
 
   Args:
       credentials: An optional Credentials object.
       user_info: An optional dict containing user info returned by the OAuth2 API.
+      id: The ID of the user whose refresh token is updated. Defaults to the
+          login_hint in the session.
   """
 
-  existing_user = get_credentials_from_storage(flask.session.get("login_hint"))
+  if id is None:
+    id = flask.session.get("login_hint")
 
-  if existing_user:
-    if user_info:
-      existing_user.id = user_info.get("id")
-      existing_user.display_name = user_info.get("name")
-      existing_user.email = user_info.get("email")
-      existing_user.portrait_url = user_info.get("picture")
+  refresh_token = credentials.refresh_token if credentials else None
 
-    if credentials and credentials.refresh_token is not None:
-      existing_user.refresh_token = credentials.refresh_token
-
-  elif credentials and user_info:
-    new_user = User(
+  if user_info:
+    # Insert the user, or update their record if it already exists.
+    statement = sqlite.insert(User).values(
         id=user_info.get("id"),
         display_name=user_info.get("name"),
         email=user_info.get("email"),
         portrait_url=user_info.get("picture"),
-        refresh_token=credentials.refresh_token,
+        refresh_token=refresh_token,
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[User.id],
+        set_={
+            "display_name": statement.excluded.display_name,
+            "email": statement.excluded.email,
+            "portrait_url": statement.excluded.portrait_url,
+            # Keep the stored refresh token if none was issued this time.
+            "refresh_token": sqlalchemy.func.coalesce(
+                statement.excluded.refresh_token, User.refresh_token
+            ),
+        },
     )
 
-    db.session.add(new_user)
+  elif refresh_token is not None:
+    statement = (
+        sqlalchemy.update(User)
+        .where(User.id == id)
+        .values(refresh_token=refresh_token)
+    )
 
+  else:
+    return
+
+  db.session.execute(statement)
   db.session.commit()
+
+  # Drop any cached copies of the record that was just written.
+  forget_cached_credentials(id, user_info and user_info.get("id"))
+
+
+def save_user_credentials_in_background(credentials):
+  """
+  Updates the stored refresh token of the signed-in user on a background
+  thread, without waiting for the write to finish.
+
+  Args:
+      credentials: A Credentials object.
+  """
+
+  _background_writer.submit(
+      _save_user_credentials_with_app_context,
+      credentials,
+      flask.session.get("login_hint"),
+  )
+
+
+def _save_user_credentials_with_app_context(credentials, id):
+  """
+  Runs save_user_credentials() outside of a request, in its own app context
+  and therefore its own database session. Errors are logged, since there is
+  no request to report them to.
+  """
+
+  with app.app_context():
+    try:
+      save_user_credentials(credentials, id=id)
+    except Exception:
+      app.logger.exception("Failed to save credentials for user %s.", id)
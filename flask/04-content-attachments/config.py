@@ -14,7 +14,9 @@
 # the License.
 """The Flask server configuration."""
 
+from datetime import timedelta
 import os
+from sqlalchemy.pool import QueuePool
 
 DATABASE_FILE_NAME = os.path.join(
     os.path.abspath(os.path.dirname(__file__)), "data.sqlite"
@@ -36,6 +38,32 @@ class Config(object):
   SESSION_COOKIE_HTTPONLY = True
   SESSION_COOKIE_SAMESITE = "None"
 
+  # Store session data server-side with Flask-Session, in the same database as
+  # the users, so the cookie only holds a signed session ID rather than the
+  # user's tokens and the add-on's query parameters.
+  SESSION_TYPE = "sqlalchemy"
+  SESSION_USE_SIGNER = True
+
+  # Stored sessions expire after this long. Flask-Session's database backend
+  # needs an expiry on every session row. Access tokens only last an hour, and
+  # the add-on iframe signs the user back in from the login_hint query
+  # parameter.
+  PERMANENT_SESSION_LIFETIME = timedelta(hours=12)
+
   # Point to a database file in the project root.
   SQLALCHEMY_DATABASE_URI = f"sqlite:///{DATABASE_FILE_NAME}"
   SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+  # Keep a pool of open database connections rather than opening a new one for
+  # every request, which is SQLAlchemy's default for SQLite files. Connections
+  # are shared between threads, so SQLite's same-thread check is disabled. A
+  # write waits up to 30 seconds for another connection's lock to be released
+  # instead of failing with "database is locked".
+  SQLALCHEMY_ENGINE_OPTIONS = {
+      "poolclass": QueuePool,
+      "pool_size": 20,
+      "max_overflow": 30,
+      "pool_pre_ping": True,
+      "pool_recycle": 1800,
+      "connect_args": {"check_same_thread": False, "timeout": 30},
+  }
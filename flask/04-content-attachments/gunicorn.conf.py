@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Gunicorn configuration for the Flask server.
+
+The OAuth callbacks spend nearly all of their time waiting on Google's token
+endpoint, and the attachment views on the Classroom API. gevent workers let a
+request blocked on the network yield to others instead of holding up the
+whole worker process. Gunicorn's gevent worker monkey-patches the standard
+library itself when it starts.
+
+The app isn't preloaded: each worker imports it after forking, and then starts
+its own background token refresher thread in post_worker_init."""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+workers = int(
+    os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1)
+)
+worker_class = "gevent"
+worker_connections = 1000
+
+
+def post_worker_init(worker):
+  """Starts the background token refresher once the worker has loaded the app."""
+  from webapp import start_token_refresher
+
+  start_token_refresher()
@@ -36,10 +36,23 @@ Review these resources for additional security considerations:
 + OAuth 2.0 Threat Model and Security Considerations:
   https://datatracker.ietf.org/doc/html/rfc6819"""
 
-from webapp import app
+from webapp import app, db, start_token_refresher
 import os
+from werkzeug.serving import is_running_from_reloader
 
 if __name__ == "__main__":
+  # Create the database tables if they don't exist yet. When the app is served
+  # some other way, such as by Gunicorn, run `flask --app webapp init-db` once
+  # before starting it instead.
+  db.create_all()
+
+  # Start the background token refresher. The reloader that debug=True enables
+  # also runs this file in a parent process that only watches for changes, so
+  # the refresher is started in the child process that serves requests. If you
+  # turn the reloader off, call start_token_refresher() unconditionally.
+  if is_running_from_reloader():
+    start_token_refresher()
+
   # You have several options for running the web server.
 
   ### OPTION 1: Unsecured localhost
@@ -64,7 +77,10 @@ if __name__ == "__main__":
   )
 
   ### OPTION 3: Production- or cloud-ready server
-  # Start a Gunicorn server, which is appropriate for use in production or a
-  # cloud deployment.
-  # server_port = os.environ.get("PORT", "8080")
-  # app.run(debug=True, port=server_port, host="0.0.0.0")
+  # Don't run this file; start a Gunicorn server instead, which is appropriate
+  # for use in production or a cloud deployment. The settings in
+  # gunicorn.conf.py run several gevent workers and listen on $PORT
+  # (default 8080):
+  #
+  #   flask --app webapp init-db
+  #   gunicorn -c gunicorn.conf.py wsgi:app
@@ -16,19 +16,82 @@
 
 Starts the flask server, loads the config, and initializes the database."""
 
+from apscheduler.schedulers.background import BackgroundScheduler
 import flask
 import config
+from flask_session import Session
 from flask_sqlalchemy import SQLAlchemy
-from os import path
+import jinja2
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sqlite3
 
 app = flask.Flask(__name__)
 app.config.from_object(config.Config)
 
 db = SQLAlchemy(app)
 
+# Persist compiled templates on disk so that new worker processes don't have to
+# compile them again.
+app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache()
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+  """Configures each new SQLite connection for concurrent access.
+
+  Write-ahead logging lets readers proceed while a write is in progress, and
+  synchronous=NORMAL is safe in WAL mode while syncing to disk far less often.
+  """
+  if not isinstance(dbapi_connection, sqlite3.Connection):
+    return
+
+  cursor = dbapi_connection.cursor()
+  cursor.execute("PRAGMA journal_mode=WAL")
+  cursor.execute("PRAGMA synchronous=NORMAL")
+  cursor.execute("PRAGMA temp_store=MEMORY")
+  cursor.execute("PRAGMA mmap_size=268435456")
+  cursor.close()
+
+
 from webapp import attachment_routes, attachment_discovery_routes, models
 from webapp import credential_handler as ch
 
-# Initialize the database file if not created.
-if not path.exists(config.DATABASE_FILE_NAME):
+# Keep session data in the database; the cookie only carries the session ID.
+app.config["SESSION_SQLALCHEMY"] = db
+Session(app)
+
+# Load every template once at startup instead of on its first request.
+for template_name in app.jinja_env.list_templates():
+  app.jinja_env.get_template(template_name)
+
+
+@app.cli.command("init-db")
+def init_db():
+  """Creates any tables that don't exist yet, including the sessions table.
+
+  Run once before starting the server, rather than on every import of this
+  module by each worker process.
+  """
   db.create_all()
+
+
+# Refreshes access tokens in the background shortly before they expire, so
+# that requests don't have to wait for the refresh.
+scheduler = BackgroundScheduler(daemon=True)
+scheduler.add_job(
+    ch._credential_handler.refresh_expiring_access_tokens,
+    "interval",
+    seconds=60,
+)
+
+
+def start_token_refresher():
+  """Starts the background token refresher in the current process.
+
+  Called by the process that serves requests rather than on import, so that
+  commands such as `flask --app webapp init-db`, and the development server's
+  reloader process, don't start it.
+  """
+  if not scheduler.running:
+    scheduler.start()
@@ -19,7 +19,6 @@ from webapp import credential_handler as ch
 
 import json
 import flask
-import requests
 
 import google.oauth2.credentials
 import googleapiclient.discovery
@@ -117,8 +116,8 @@ def test_api_request(request_type="username"):
   fetched_data = ""
 
   if request_type == "username":
-    user_info_service = googleapiclient.discovery.build(
-        serviceName="oauth2", version="v2", credentials=credentials
+    user_info_service = googleapiclient.discovery.build_from_document(
+        ch.get_discovery_document("oauth2", "v2"), credentials=credentials
     )
 
     flask.session["username"] = (
@@ -196,7 +195,7 @@ def revoke():
       **flask.session["credentials"]
   )
 
-  revoke = requests.post(
+  revoke_response = ch._http_session.post(
       "https://oauth2.googleapis.com/revoke",
       params={"token": credentials.token},
       headers={"content-type": "application/x-www-form-urlencoded"},
@@ -204,8 +203,7 @@ def revoke():
 
   ch._credential_handler.clear_credentials_in_session()
 
-  status_code = getattr(revoke, "status_code")
-  if status_code == 200:
+  if revoke_response.status_code == 200:
     return ch.start_auth_flow("discovery_callback")
   else:
     return flask.render_template(
@@ -20,23 +20,51 @@ from webapp import db
 from webapp import credential_handler as ch
 
 from flask_wtf import FlaskForm
+from flask_wtf.csrf import validate_csrf
 from wtforms import BooleanField, SubmitField
+from wtforms.validators import ValidationError
 
+import cachetools
+import functools
+import json
 import os
 import flask
-import pprint
+import threading
+import urllib.parse
 
+# Recent Classroom API responses for the attachment views, keyed by the
+# request and the user that made it. The add-on context of an item rarely
+# changes, so reloading an attachment within a minute reuses the response
+# rather than waiting on the API again.
+_api_response_cache = cachetools.TTLCache(maxsize=1024, ttl=60)
+_api_response_cache_lock = threading.Lock()
 
+
+def format_for_display(value):
+  """Formats an API request or response body for display on a page.
+
+  Args:
+      value: A JSON-compatible value, such as a dictionary.
+  Returns:
+      The value as indented JSON.
+  """
+  return json.dumps(value, indent=2, default=str)
+
+
+@functools.lru_cache(maxsize=None)
 def image_list_form_builder(image_filenames):
-  """Builds a form composed of checkboxes and captions.
+  """Builds a form class composed of checkboxes and captions.
 
   This has to be done dynamically since FieldList doesn't support checkboxes:
   https://wtforms.readthedocs.io/en/2.3.x/fields/#wtforms.fields.FieldList
 
+  The class is only built once for each set of images; instantiate it to get
+  a form for each request.
+
   Args:
-      image_filenames: A list of image filenames.
+      image_filenames: A tuple of image filenames.
   Returns:
-      A FlaskForm object with a series of checkboxes and the attribute names
+      A FlaskForm subclass with a series of checkboxes and the attribute names
       assigned to them.
   """
 
@@ -44,51 +72,86 @@ def image_list_form_builder(image_filenames):
     pass
 
   name_pairs = []
-
-  # For this example, images have the format "landmark-name.type".
-  image_captions = [
-      x.split(".")[0].replace("-", " ").title() for x in image_filenames
-  ]
+  image_captions = get_image_captions(image_filenames)
 
   # Add a checkbox for each image to the form, named by the image filename.
   for i in range(len(image_filenames)):
     setattr(
         ImageListForm,
         f"selected_{i}",
-        BooleanField(label=image_captions[i], name=image_filenames[i]),
+        BooleanField(
+            label=image_captions[image_filenames[i]], name=image_filenames[i]
+        ),
     )
     name_pairs.append(f"selected_{i}")
 
   # Add a submit button to the form.
   setattr(ImageListForm, "submit", SubmitField("Submit"))
-  return ImageListForm(), name_pairs
+  return ImageListForm, name_pairs
+
+
+@functools.lru_cache(maxsize=None)
+def get_image_filenames():
+  """Lists the filenames in the static/images directory.
 
+  The directory is only read once per process, so restart the server after
+  adding or removing images.
 
-def construct_filename_caption_dictionary_list(form):
+  Returns:
+      A tuple of image filenames.
+  """
+  return tuple(os.listdir(os.path.join(app.static_folder, "images")))
+
+
+@functools.lru_cache(maxsize=None)
+def get_image_captions(image_filenames):
+  """Builds a caption for each image from its filename.
+
+  Args:
+      image_filenames: A tuple of image filenames.
+  Returns:
+      A dictionary that maps image filenames to captions.
+  """
+  # For this example, images have the format "landmark-name.type".
+  return {
+      x: x.split(".")[0].replace("-", " ").title() for x in image_filenames
+  }
+
+
+def construct_filename_caption_dictionary_list(submitted_form, image_filenames):
   """
   Construct a dictionary that maps filenames to captions.
 
-  There will be one dictionary entry per checked item in the form.
+  There will be one dictionary entry per checked item in the form. Browsers
+  only submit checkboxes that are checked, named by the image filename.
 
   Args:
-      form: A completed, validated form.
+      submitted_form: The submitted form data.
+      image_filenames: A tuple of the image filenames offered in the form.
   Returns:
       A dictionary that maps image filenames to captions.
   """
-  selected_images = [
-      key
-      for key, value in form.data.items()
-      if value is True and key != "submit"
-  ]
+  image_captions = get_image_captions(image_filenames)
 
   filename_caption_pairs = {
-      form[image_id].name: form[image_id].label.text
-      for image_id in selected_images
+      image_filename: image_captions[image_filename]
+      for image_filename in image_filenames
+      if image_filename in submitted_form
   }
 
   return filename_caption_pairs
 
 
+def is_csrf_token_valid():
+  """Checks the CSRF token submitted with the current request's form."""
+  try:
+    validate_csrf(flask.request.form.get("csrf_token"))
+  except ValidationError:
+    return False
+
+  return True
+
+
 @app.route("/attachment-options", methods=["GET", "POST"])
 def attachment_options():
   """
@@ -100,15 +163,19 @@ def attachment_options():
   """
 
   # A list of the filenames in the static/images directory.
-  image_filenames = os.listdir(os.path.join(app.static_folder, "images"))
+  image_filenames = get_image_filenames()
 
   # Create a form from the list of images. Store the list of attribute names
   # in the form.
-  form, var_names = image_list_form_builder(image_filenames)
+  image_list_form, var_names = image_list_form_builder(image_filenames)
 
   # If the form was submitted, validate the input and create the attachments.
-  if form.validate_on_submit():
-    filename_caption_pairs = construct_filename_caption_dictionary_list(form)
+  # The checkboxes are read from the request directly rather than through the
+  # form's fields; only the CSRF token needs validating.
+  if flask.request.method == "POST" and is_csrf_token_valid():
+    filename_caption_pairs = construct_filename_caption_dictionary_list(
+        flask.request.form, image_filenames
+    )
 
     if len(filename_caption_pairs) > 0:
       return create_attachments(filename_caption_pairs)
@@ -116,7 +183,7 @@ def attachment_options():
       return flask.render_template(
           "create-attachment.html",
           message="You didn't select any images.",
-          form=form,
+          form=image_list_form(),
           var_names=var_names,
       )
 
@@ -126,7 +193,7 @@ def attachment_options():
           "You've reached the attachment options page. "
           "Select one or more images and click 'Create Attachment'."
       ),
-      form=form,
+      form=image_list_form(),
       var_names=var_names,
   )
 
@@ -145,31 +212,61 @@ def create_attachments(filename_caption_pairs):
   response_strings = []
   request_strings = []
 
+  def store_attachment(request_id, resp, exception):
+    """Stores an attachment once its create request has returned."""
+    if exception is not None:
+      raise exception
+
+    response_strings.append(format_for_display(resp))
+
+    # Store the value by id.
+    key, value = image_by_request_id[request_id]
+    new_attachment = Attachment(
+        # The new attachment's unique ID, returned in the CREATE response.
+        attachment_id=resp.get("id"),
+        image_filename=key,
+        image_caption=value,
+    )
+    db.session.add(new_attachment)
+
+  # Send all of the create requests to Classroom in a single batch request,
+  # rather than one round trip per attachment. The callback runs for each
+  # response, in order.
+  batch = classroom_service.new_batch_http_request(callback=store_attachment)
+  image_by_request_id = {}
+
+  # The route that loads an attachment. Each attachment adds its image to it.
+  load_content_attachment_url = flask.url_for(
+      "load_content_attachment", _scheme="https", _external=True
+  )
+
   # Create a new attachment for each image that was selected.
   attachment_count = 0
   for key, value in filename_caption_pairs.items():
     attachment_count += 1
+
+    # The image is included in the URI so that loading the attachment doesn't
+    # need to look it up.
+    view_uri = (
+        f"{load_content_attachment_url}?"
+        + urllib.parse.urlencode({"image_filename": key})
+    )
+
     attachment = {
         # Specifies the route for a teacher user.
-        "teacherViewUri": {
-            "uri": flask.url_for(
-                "load_content_attachment", _scheme="https", _external=True
-            )
-        },
+        "teacherViewUri": {"uri": view_uri},
         # Specifies the route for a student user.
-        "studentViewUri": {
-            "uri": flask.url_for(
-                "load_content_attachment", _scheme="https", _external=True
-            )
-        },
+        "studentViewUri": {"uri": view_uri},
         # The title of the attachment.
         "title": f"Attachment {attachment_count}",
     }
 
-    request_strings.append(pprint.pformat(attachment))
+    request_strings.append(format_for_display(attachment))
 
-    # Issue a request to create an attachment on an assignment.
-    resp = (
+    # Add a request to create an attachment on an assignment.
+    request_id = str(attachment_count)
+    image_by_request_id[request_id] = (key, value)
+    batch.add(
         classroom_service.courses()
         .courseWork()
         .addOnAttachments()
@@ -178,21 +275,14 @@ def create_attachments(filename_caption_pairs):
             itemId=flask.session["itemId"],
             addOnToken=flask.session["addOnToken"],
             body=attachment,
-        )
-        .execute()
+        ),
+        request_id=request_id,
     )
 
-    response_strings.append(pprint.pformat(resp))
+  batch.execute()
 
-    # Store the value by id.
-    new_attachment = Attachment(
-        # The new attachment's unique ID, returned in the CREATE response.
-        attachment_id=resp.get("id"),
-        image_filename=key,
-        image_caption=value,
-    )
-    db.session.add(new_attachment)
-    db.session.commit()
+  # Store all of the new attachments in a single transaction.
+  db.session.commit()
 
   return flask.render_template(
       "create-attachment.html",
@@ -205,6 +295,72 @@ def create_attachments(filename_caption_pairs):
   )
 
 
+def execute_with_cache(cache_key, build_request):
+  """Executes a Classroom API request, or returns its recent response.
+
+  Args:
+      cache_key: A tuple identifying the request and the signed-in user.
+      build_request: A function that returns the request to execute on a
+          cache miss.
+  Returns:
+      The API response.
+  """
+  with _api_response_cache_lock:
+    if cache_key in _api_response_cache:
+      return _api_response_cache[cache_key]
+
+  response = build_request().execute()
+
+  with _api_response_cache_lock:
+    _api_response_cache[cache_key] = response
+
+  return response
+
+
+def get_addon_context(course_id, item_id):
+  """Gets the signed-in user's add-on context for a course work item.
+
+  Args:
+      course_id: The ID of the course.
+      item_id: The ID of the course work item.
+  Returns:
+      The getAddOnContext response.
+  """
+  return execute_with_cache(
+      ("getAddOnContext", flask.session["login_hint"], course_id, item_id),
+      lambda: ch._credential_handler.get_classroom_service()
+      .courses()
+      .courseWork()
+      .getAddOnContext(courseId=course_id, itemId=item_id),
+  )
+
+
+def get_addon_attachment(course_id, item_id, attachment_id):
+  """Gets an add-on attachment on a course work item.
+
+  Args:
+      course_id: The ID of the course.
+      item_id: The ID of the course work item.
+      attachment_id: The ID of the attachment.
+  Returns:
+      The addOnAttachments.get response.
+  """
+  return execute_with_cache(
+      (
+          "addOnAttachments.get",
+          flask.session["login_hint"],
+          course_id,
+          item_id,
+          attachment_id,
+      ),
+      lambda: ch._credential_handler.get_classroom_service()
+      .courses()
+      .courseWork()
+      .addOnAttachments()
+      .get(courseId=course_id, itemId=item_id, attachmentId=attachment_id),
+  )
+
+
 @app.route("/load-content-attachment")
 def load_content_attachment():
   """
@@ -222,6 +378,8 @@ def load_content_attachment():
     flask.session["courseId"] = flask.request.args.get("courseId")
   if flask.request.args.get("attachmentId"):
     flask.session["attachmentId"] = flask.request.args.get("attachmentId")
+    # Attachments record their image in their URI; older ones don't.
+    flask.session["imageFilename"] = flask.request.args.get("image_filename")
 
   # If the login_hint query parameter is available, we'll store it in the session.
   if flask.request.args.get("login_hint"):
@@ -245,20 +403,11 @@ def load_content_attachment():
   if credentials is None:
     return ch.start_auth_flow("attachment_callback")
 
-  # Create an instance of the Classroom service.
-  classroom_service = ch._credential_handler.get_classroom_service()
-
-  addon_context_response = (
-      classroom_service.courses()
-      .courseWork()
-      .getAddOnContext(
-          courseId=flask.session["courseId"],
-          itemId=flask.session["itemId"],
-      )
-      .execute()
+  addon_context_response = get_addon_context(
+      flask.session["courseId"], flask.session["itemId"]
   )
 
-  response_strings = [pprint.pformat(addon_context_response)]
+  response_strings = [format_for_display(addon_context_response)]
 
   # Determine which view we are in by testing the returned context type.
   user_context = (
@@ -266,26 +415,30 @@ def load_content_attachment():
   )
 
   if user_context == "teacher":
-    attachment_response = (
-        classroom_service.courses()
-        .courseWork()
-        .addOnAttachments()
-        .get(
-            courseId=flask.session["courseId"],
-            itemId=flask.session["itemId"],
-            attachmentId=flask.session["attachmentId"],
-        )
-        .execute()
+    attachment_response = get_addon_attachment(
+        flask.session["courseId"],
+        flask.session["itemId"],
+        flask.session["attachmentId"],
     )
 
-    response_strings.append(pprint.pformat(attachment_response))
+    response_strings.append(format_for_display(attachment_response))
+
+  # Use the image named in the attachment's URI if it's one of ours. The
+  # caption is derived from the filename, as it was when the attachment was
+  # created. Otherwise, look up the attachment in the database.
+  image_filename = flask.session.get("imageFilename")
+  image_captions = get_image_captions(get_image_filenames())
 
-  # Look up the attachment in the database.
-  attachment = Attachment.query.get(flask.session["attachmentId"])
+  if image_filename in image_captions:
+    image_caption = image_captions[image_filename]
+  else:
+    attachment = Attachment.query.get(flask.session["attachmentId"])
+    image_filename = attachment.image_filename
+    image_caption = attachment.image_caption
 
   message_str = f"I see that you are a {user_context}! "
   message_str += (
-      f"I've loaded the attachment with ID {attachment.attachment_id}. "
+      f"I've loaded the attachment with ID {flask.session['attachmentId']}. "
       if user_context == "teacher"
       else "Please enjoy this image of a famous landmark!"
   )
@@ -293,8 +446,8 @@ def load_content_attachment():
   return flask.render_template(
       "show-content-attachment.html",
       message=message_str,
-      image_filename=attachment.image_filename,
-      image_caption=attachment.image_caption,
+      image_filename=image_filename,
+      image_caption=image_caption,
       responses=response_strings,
   )
 
@@ -16,13 +16,23 @@
 
 from webapp.models import User
 from webapp import app, db
+import cachetools
+import concurrent.futures
+import datetime
 import json
 import flask
 import os
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+from urllib3.util.retry import Retry
 
+import google.auth.exceptions
+import google.auth.transport.requests
 import google.oauth2.credentials
 import google_auth_oauthlib.flow
 import googleapiclient.discovery
+import googleapiclient.discovery_cache
 
 # This variable specifies the name of a file that contains the OAuth 2.0
 # information for this application, including its client_id and client_secret.
@@ -47,6 +57,28 @@ CLASSROOM_API_VERSION = "v1"
 # https://console.cloud.google.com/apis/credentials.
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 
+# How long a fetched discovery document is reused before it's fetched again,
+# so that changes to the API surface are eventually picked up.
+DISCOVERY_DOCUMENT_TTL_SECONDS = 60 * 60
+
+# A shared HTTP session for requests made directly to Google's OAuth and
+# discovery endpoints. Reusing its connection pool avoids a new TCP and TLS
+# handshake per request.
+_http_session = requests.Session()
+_http_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.1),
+    ),
+)
+
+# The background refresher renews access tokens that expire within
+# REFRESH_AHEAD, for users who have made a request within REFRESH_IDLE_LIMIT.
+REFRESH_AHEAD = datetime.timedelta(minutes=5)
+REFRESH_IDLE_LIMIT = datetime.timedelta(minutes=30)
+
 
 class CredentialHandler:
   """Provides the CredentialHandler object to manage OAuth credentials."""
@@ -58,7 +90,17 @@ class CredentialHandler:
         client_secrets_file: The path to the client secrets file.
     """
     self._client_secrets_dict = json.load(open(client_secrets_file)).get("web")
-    self._credentials = None
+
+    # The current access token of each recently active user, keyed by user ID.
+    # Each entry is a dictionary with the token, its expiry and the time it
+    # was last used.
+    self._access_tokens = {}
+    self._access_tokens_lock = threading.Lock()
+
+    # Token refreshes in progress, keyed by user ID. Each is a Future that
+    # resolves to the new token and its expiry, so that concurrent requests
+    # for the same user share a single refresh.
+    self._refreshes_in_progress = {}
 
   def get_credentials(self, user_id=None):
     """Gets the OAuth credentials for a user.
@@ -85,11 +127,148 @@ class CredentialHandler:
     ):
       return None
 
-    self._credentials = google.oauth2.credentials.Credentials(
+    # The credentials are local to this request. The handler is shared by
+    # every request, and the refresh below may yield to other requests.
+    credentials = google.oauth2.credentials.Credentials(
         **flask.session["credentials"]
     )
 
-    return self._credentials
+    # Use the access token kept for this user, which the background refresher
+    # keeps current. Only refresh here if there isn't a valid one.
+    user_id = flask.session.get("login_hint")
+    if user_id is not None:
+      self.load_access_token(user_id, credentials)
+      if not credentials.valid:
+        self.refresh_access_token(user_id, credentials)
+
+    return credentials
+
+  def load_access_token(self, user_id, credentials):
+    """Loads a user's current access token, if any, into their credentials.
+
+    Args:
+        user_id: The user's ID.
+        credentials: The user's Credentials object.
+    """
+    with self._access_tokens_lock:
+      access_token = self._access_tokens.get(user_id)
+      if access_token is None:
+        return
+
+      access_token["last_used"] = datetime.datetime.utcnow()
+      credentials.token = access_token["token"]
+      credentials.expiry = access_token["expiry"]
+
+  def store_access_token(self, user_id, credentials):
+    """Keeps a user's access token so that later requests can reuse it.
+
+    Args:
+        user_id: The user's ID.
+        credentials: The user's Credentials object, with a current token.
+    """
+    with self._access_tokens_lock:
+      self._access_tokens[user_id] = {
+          "token": credentials.token,
+          "expiry": credentials.expiry,
+          "last_used": datetime.datetime.utcnow(),
+      }
+
+  def refresh_access_token(self, user_id, credentials):
+    """Obtains a new access token for a user and keeps it for later requests.
+
+    Args:
+        user_id: The user's ID.
+        credentials: The user's Credentials object, with a refresh token.
+    """
+    self.refresh_once(user_id, credentials)
+    self.store_access_token(user_id, credentials)
+
+  def refresh_once(self, user_id, credentials):
+    """Refreshes a user's credentials, unless a refresh is already in progress.
+
+    If another thread is already refreshing the user's access token, waits for
+    it to finish and uses its result rather than requesting another token.
+
+    Args:
+        user_id: The user's ID.
+        credentials: The user's Credentials object, with a refresh token.
+    """
+    with self._access_tokens_lock:
+      refresh = self._refreshes_in_progress.get(user_id)
+      in_progress = refresh is not None
+      if not in_progress:
+        refresh = concurrent.futures.Future()
+        self._refreshes_in_progress[user_id] = refresh
+
+    if in_progress:
+      credentials.token, credentials.expiry = refresh.result()
+      return
+
+    try:
+      credentials.refresh(
+          google.auth.transport.requests.Request(session=_http_session)
+      )
+      refresh.set_result((credentials.token, credentials.expiry))
+    except Exception as e:
+      refresh.set_exception(e)
+      raise
+    finally:
+      with self._access_tokens_lock:
+        del self._refreshes_in_progress[user_id]
+
+  def refresh_expiring_access_tokens(self):
+    """Refreshes the access tokens that are about to expire.
+
+    Runs periodically in the background, so that requests rarely have to wait
+    for a token refresh. Tokens of users who haven't made a request recently
+    are dropped instead.
+    """
+    now = datetime.datetime.utcnow()
+
+    with self._access_tokens_lock:
+      for user_id, access_token in list(self._access_tokens.items()):
+        if now - access_token["last_used"] > REFRESH_IDLE_LIMIT:
+          del self._access_tokens[user_id]
+
+      expiring_user_ids = [
+          user_id
+          for user_id, access_token in self._access_tokens.items()
+          if access_token["expiry"] is None
+          or access_token["expiry"] - now < REFRESH_AHEAD
+      ]
+
+    for user_id in expiring_user_ids:
+      with app.app_context():
+        user = User.query.get(user_id)
+
+      if user is None or user.refresh_token is None:
+        with self._access_tokens_lock:
+          self._access_tokens.pop(user_id, None)
+        continue
+
+      credentials = google.oauth2.credentials.Credentials(
+          token=None,
+          refresh_token=user.refresh_token,
+          token_uri=self._client_secrets_dict["token_uri"],
+          client_id=self._client_secrets_dict["client_id"],
+          client_secret=self._client_secrets_dict["client_secret"],
+          scopes=SCOPES,
+      )
+
+      try:
+        self.refresh_once(user_id, credentials)
+      except google.auth.exceptions.RefreshError:
+        app.logger.exception("Failed to refresh the token of %s.", user_id)
+        with self._access_tokens_lock:
+          self._access_tokens.pop(user_id, None)
+        continue
+
+      with self._access_tokens_lock:
+        # Keep the time of the user's last request.
+        if user_id in self._access_tokens:
+          self._access_tokens[user_id].update(
+              token=credentials.token, expiry=credentials.expiry
+          )
 
   def session_credentials_to_dict(self, credentials):
     """Converts the credentials from the session to a dictionary.
@@ -157,13 +336,17 @@ class CredentialHandler:
     """
 
     # Issue a request for the user's profile details.
-    user_info_service = googleapiclient.discovery.build(
-        serviceName="oauth2", version="v2", credentials=credentials
+    user_info_service = googleapiclient.discovery.build_from_document(
+        get_discovery_document("oauth2", "v2"), credentials=credentials
     )
     user_info = user_info_service.userinfo().get().execute()
     flask.session["username"] = user_info.get("name")
     flask.session["login_hint"] = user_info.get("id")
 
+    # Keep the access token for the user's later requests.
+    if credentials.valid:
+      self.store_access_token(user_info.get("id"), credentials)
+
     # See if we have any stored credentials for this user. If they have used
     # the add-on before, we should have received login_hint in the query
     # parameters.
@@ -200,19 +383,9 @@ class CredentialHandler:
     Returns:
         The Google Classroom discovery service.
     """
-    return (
-        googleapiclient.discovery.build(
-            serviceName=service_name,
-            version=version,
-            credentials=self.get_credentials(),
-        )
-        if service_url is None
-        else googleapiclient.discovery.build(
-            serviceName=service_name,
-            version=version,
-            discoveryServiceUrl=service_url,
-            credentials=self.get_credentials(),
-        )
+    return googleapiclient.discovery.build_from_document(
+        get_discovery_document(service_name, version, service_url),
+        credentials=self.get_credentials(),
     )
 
   def get_classroom_service(self):
@@ -239,6 +412,32 @@ class CredentialHandler:
 _credential_handler = CredentialHandler()
 
 
+@cachetools.cached(
+    cachetools.TTLCache(maxsize=16, ttl=DISCOVERY_DOCUMENT_TTL_SECONDS),
+    lock=threading.Lock(),
+)
+def get_discovery_document(service_name, version, service_url=None):
+  """Gets the discovery document for an API, caching it for an hour.
+
+  Args:
+      service_name: The name of the API.
+      version: The version of the API.
+      service_url: Optional URL to fetch the document from. If not provided,
+          the document bundled with the client library is used.
+
+  Returns:
+      The parsed discovery document.
+  """
+  if service_url is None:
+    return json.loads(
+        googleapiclient.discovery_cache.get_static_doc(service_name, version)
+    )
+
+  response = _http_session.get(service_url)
+  response.raise_for_status()
+  return response.json()
+
+
 @app.route("/start-auth-flow/<redirect_destination>")
 def start_auth_flow(redirect_destination):
   """
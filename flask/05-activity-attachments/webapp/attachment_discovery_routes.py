@@ -184,7 +184,7 @@ def revoke():
       **flask.session["credentials"]
   )
 
-  revoke = requests.post(
+  revoke_response = requests.post(
       "https://oauth2.googleapis.com/revoke",
       params={"token": credentials.token},
       headers={"content-type": "application/x-www-form-urlencoded"},
@@ -192,8 +192,7 @@ def revoke():
 
   ch._credential_handler.clear_credentials_in_session()
 
-  status_code = getattr(revoke, "status_code")
-  if status_code == 200:
+  if revoke_response.status_code == 200:
     return ch.start_auth_flow("discovery_callback")
   else:
     return flask.render_template(
@@ -16,19 +16,56 @@
 
 Starts the flask server, loads the config, and initializes the database."""
 
+from cryptography.fernet import Fernet
 import flask
 import config
+from flask_session import Session
 from flask_sqlalchemy import SQLAlchemy
-from os import path
+import msgpack
 
 app = flask.Flask(__name__)
 app.config.from_object(config.Config)
 
 db = SQLAlchemy(app)
 
+
+class EncryptedSessionSerializer(object):
+  """Serializes session data with msgpack and encrypts it with Fernet.
+
+  Used for session stores outside the app, such as Redis, so that the
+  credentials in the session aren't readable by anyone with access to the
+  store.
+  """
+
+  def __init__(self, key):
+    self._fernet = Fernet(key)
+
+  def dumps(self, data):
+    return self._fernet.encrypt(msgpack.packb(data))
+
+  def loads(self, data):
+    return msgpack.unpackb(self._fernet.decrypt(data))
+
+
 from webapp import attachment_routes, attachment_discovery_routes, models
 from webapp import credential_handler as ch
 
-# Initialize the database file if not created.
-if not path.exists(config.DATABASE_FILE_NAME):
-  db.create_all()
+# Keep session data server-side; the cookie only carries the session ID.
+app.config["SESSION_SQLALCHEMY"] = db
+Session(app)
+
+# Encrypt sessions kept in Redis. Refusing to start without a key means
+# sessions are never stored there unencrypted by mistake.
+if app.config["SESSION_TYPE"] == "redis":
+  if not app.config["SESSION_ENCRYPTION_KEY"]:
+    raise RuntimeError(
+        "SESSION_ENCRYPTION_KEY must be set when REDIS_URL is set."
+    )
+
+  app.session_interface.serializer = EncryptedSessionSerializer(
+      app.config["SESSION_ENCRYPTION_KEY"]
+  )
+
+# Create any tables that don't exist yet, including the sessions table, which
+# Flask-Session doesn't create in an existing database.
+db.create_all()
@@ -23,9 +23,14 @@ from flask_wtf import FlaskForm
 from wtforms import BooleanField, SubmitField, StringField
 from wtforms.validators import DataRequired
 
+import cachetools
+import concurrent.futures
+import functools
+import json
 import os
 import flask
-import pprint
+import orjson
+import threading
 
 # This example demonstrates grade passback at two different moments.
 # Set this value to True to pass back grades when the teacher opens the Student
@@ -34,18 +39,70 @@ import pprint
 # activity.
 SET_GRADE_WITH_LOGGED_IN_USER_CREDENTIALS = False
 
+# The query parameters passed to the iframe that are saved in the session.
+IFRAME_QUERY_PARAMETERS = (
+    "itemId",
+    "itemType",
+    "courseId",
+    "addOnToken",
+    "attachmentId",
+    "submissionId",
+    "login_hint",
+)
 
+# Recent student submission responses, keyed by the submission. A student
+# loads the activity and then posts their response to the same route, so the
+# post reuses the state fetched for the page instead of asking Classroom again.
+_submission_cache = cachetools.TTLCache(maxsize=1024, ttl=60)
+_submission_cache_lock = threading.Lock()
+
+# Passes grades back to Classroom after the student's response is recorded, so
+# that the student doesn't wait on the API before seeing the acknowledgement.
+_grade_passback_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+
+def should_show_api_trace():
+  """Reports whether API requests and responses should be shown on pages.
+
+  Returns:
+      True if the app is running in debug mode or SHOW_API_TRACE is set.
+  """
+  return app.debug or app.config["SHOW_API_TRACE"]
+
+
+def format_for_display(value):
+  """Formats an API request or response body for display on a page.
+
+  Args:
+      value: A JSON-compatible value, such as a dictionary.
+  Returns:
+      The value as indented JSON with sorted keys.
+  """
+  try:
+    return orjson.dumps(
+        value, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+    ).decode()
+  except TypeError:
+    # orjson rejects some types (e.g. integers wider than 64 bits) that the
+    # standard library can still render.
+    return json.dumps(value, indent=2, sort_keys=True, default=str)
+
+
+@functools.lru_cache(maxsize=None)
 def image_list_form_builder(image_filenames):
-  """Builds a form composed of checkboxes and captions.
+  """Builds a form class composed of checkboxes and captions.
 
   This has to be done dynamically since FieldList doesn't support checkboxes:
   https://wtforms.readthedocs.io/en/2.3.x/fields/#wtforms.fields.FieldList
 
+  The class is only built once for each set of images; instantiate it to get
+  a form for each request.
+
   Args:
-      image_filenames: A list of image filenames.
+      image_filenames: A tuple of image filenames.
   Returns:
-      A FlaskForm object with a series of checkboxes and the attribute names
-      assigned to them.
+      A FlaskForm subclass with a series of checkboxes and a tuple of the
+      attribute names assigned to them.
   """
 
   class ImageListForm(FlaskForm):
@@ -55,7 +112,7 @@ def image_list_form_builder(image_filenames):
 
   # For this example, images have the format "landmark-name.type".
   image_captions = [
-      x.split(".")[0].replace("-", " ").title() for x in image_filenames
+      x.split(".", 1)[0].replace("-", " ").title() for x in image_filenames
   ]
 
   # Add a checkbox for each image to the form, named by the image filename.
@@ -69,10 +126,23 @@ def image_list_form_builder(image_filenames):
 
   # Add a submit button to the form.
   setattr(ImageListForm, "submit", SubmitField("Submit"))
-  return ImageListForm(), name_pairs
+  return ImageListForm, tuple(name_pairs)
+
+
+@functools.lru_cache(maxsize=None)
+def get_image_filenames():
+  """Lists the filenames in the static/images directory.
 
+  The directory is only read once per process, so restart the server after
+  adding or removing images.
 
-def construct_filename_caption_dictionary_list(form):
+  Returns:
+      A tuple of image filenames.
+  """
+  return tuple(os.listdir(os.path.join(app.static_folder, "images")))
+
+
+def construct_filename_caption_dictionary_list(form, var_names):
   """
   Construct a dictionary that maps filenames to captions.
 
@@ -80,19 +150,15 @@ def construct_filename_caption_dictionary_list(form):
 
   Args:
       form: A completed, validated form.
+      var_names: The attribute names of the form's image checkboxes.
   Returns:
       A dictionary that maps image filenames to captions.
   """
 
-  selected_images = [
-      key
-      for key, value in form.data.items()
-      if value is True and key != "submit"
-  ]
-
   filename_caption_pairs = {
-      form[image_id].name: form[image_id].label.text
-      for image_id in selected_images
+      form[var_name].name: form[var_name].label.text
+      for var_name in var_names
+      if form[var_name].data
   }
 
   return filename_caption_pairs
@@ -121,15 +187,18 @@ def attachment_options():
   """
 
   # A list of the filenames in the static/images directory.
-  image_filenames = os.listdir(os.path.join(app.static_folder, "images"))
+  image_filenames = get_image_filenames()
 
   # Create a form from the list of images. Store the list of attribute names
   # in the form.
-  form, var_names = image_list_form_builder(image_filenames)
+  image_list_form, var_names = image_list_form_builder(image_filenames)
+  form = image_list_form()
 
   # If the form was submitted, validate the input and create the attachments.
   if form.validate_on_submit():
-    filename_caption_pairs = construct_filename_caption_dictionary_list(form)
+    filename_caption_pairs = construct_filename_caption_dictionary_list(
+        form, var_names
+    )
 
     if len(filename_caption_pairs) > 0:
       return create_attachments(filename_caption_pairs)
@@ -165,6 +234,41 @@ def create_attachments(filename_caption_pairs):
 
   response_strings = []
   request_strings = []
+  show_api_trace = should_show_api_trace()
+
+  def store_attachment(request_id, resp, exception):
+    """Stores an attachment once its create request has returned."""
+    if exception is not None:
+      raise exception
+
+    if show_api_trace:
+      response_strings.append(format_for_display(resp))
+
+    # Store the value by id.
+    key, value = image_by_request_id[request_id]
+    new_attachment = Attachment(
+        # The new attachment's unique ID, returned in the CREATE response.
+        attachment_id=resp.get("id"),
+        image_filename=key,
+        image_caption=value,
+        max_points=int(resp.get("maxPoints")),
+        teacher_id=flask.session["login_hint"],
+    )
+    db.session.add(new_attachment)
+
+  # Send all of the create requests to Classroom in a single batch request,
+  # rather than one round trip per attachment. The callback runs for each
+  # response, in order.
+  batch = classroom_service.new_batch_http_request(callback=store_attachment)
+  image_by_request_id = {}
+
+  # The routes that load an attachment, which are the same for every image.
+  load_activity_attachment_url = flask.url_for(
+      "load_activity_attachment", _scheme="https", _external=True
+  )
+  view_submission_url = flask.url_for(
+      "view_submission", _scheme="https", _external=True
+  )
 
   # Create a new attachment for each image that was selected.
   attachment_count = 0
@@ -172,24 +276,12 @@ def create_attachments(filename_caption_pairs):
     attachment_count += 1
     attachment = {
         # Specifies the route for a teacher user.
-        "teacherViewUri": {
-            "uri": flask.url_for(
-                "load_activity_attachment", _scheme="https", _external=True
-            ),
-        },
+        "teacherViewUri": {"uri": load_activity_attachment_url},
         # Specifies the route for a student user.
-        "studentViewUri": {
-            "uri": flask.url_for(
-                "load_activity_attachment", _scheme="https", _external=True
-            )
-        },
+        "studentViewUri": {"uri": load_activity_attachment_url},
         # Specifies the route for a teacher user when the attachment is
         # loaded in the Classroom grading view.
-        "studentWorkReviewUri": {
-            "uri": flask.url_for(
-                "view_submission", _scheme="https", _external=True
-            )
-        },
+        "studentWorkReviewUri": {"uri": view_submission_url},
         # Sets the maximum points that a student can earn for this activity.
         # This is the denominator in a fractional representation of a grade.
         "maxPoints": 50,
@@ -197,10 +289,13 @@ def create_attachments(filename_caption_pairs):
         "title": f"Attachment {attachment_count}",
     }
 
-    request_strings.append(pprint.pformat(attachment))
+    if show_api_trace:
+      request_strings.append(format_for_display(attachment))
 
-    # Issue a request to create the attachment on an assignment.
-    resp = (
+    # Add a request to create the attachment on an assignment.
+    request_id = str(attachment_count)
+    image_by_request_id[request_id] = (key, value)
+    batch.add(
         classroom_service.courses()
         .courseWork()
         .addOnAttachments()
@@ -209,23 +304,14 @@ def create_attachments(filename_caption_pairs):
             itemId=flask.session["itemId"],
             addOnToken=flask.session["addOnToken"],
             body=attachment,
-        )
-        .execute()
+        ),
+        request_id=request_id,
     )
 
-    response_strings.append(pprint.pformat(resp))
+  batch.execute()
 
-    # Store the value by id.
-    new_attachment = Attachment(
-        # The new attachment's unique ID, returned in the CREATE response.
-        attachment_id=resp.get("id"),
-        image_filename=key,
-        image_caption=value,
-        max_points=int(resp.get("maxPoints")),
-        teacher_id=flask.session["login_hint"],
-    )
-    db.session.add(new_attachment)
-    db.session.commit()
+  # Persist all of the new attachments in a single transaction.
+  db.session.commit()
 
   return flask.render_template(
       "create-attachment.html",
@@ -238,6 +324,112 @@ def create_attachments(filename_caption_pairs):
   )
 
 
+def get_student_submission(
+    classroom_service,
+    course_id,
+    item_id,
+    attachment_id,
+    submission_id,
+    use_cache=True,
+):
+  """Gets a student's submission for an attachment, or its recent response.
+
+  Args:
+      classroom_service: The Classroom service to issue the request with.
+      course_id: The ID of the course.
+      item_id: The ID of the course work item.
+      attachment_id: The ID of the attachment.
+      submission_id: The ID of the student's submission.
+      use_cache: Whether a recent response may be returned. If False, the
+          submission is always fetched, and the fetched response is cached.
+  Returns:
+      The studentSubmissions.get response.
+  """
+  cache_key = (course_id, item_id, attachment_id, submission_id)
+
+  if use_cache:
+    with _submission_cache_lock:
+      response = _submission_cache.get(cache_key)
+    if response is not None:
+      return response
+
+  response = (
+      classroom_service.courses()
+      .courseWork()
+      .addOnAttachments()
+      .studentSubmissions()
+      .get(
+          courseId=course_id,
+          itemId=item_id,
+          attachmentId=attachment_id,
+          submissionId=submission_id,
+      )
+      .execute()
+  )
+
+  with _submission_cache_lock:
+    _submission_cache[cache_key] = response
+
+  return response
+
+
+def pass_back_grade(
+    teacher_id, course_id, item_id, attachment_id, submission_id, grade
+):
+  """
+  Sets a student's grade for an attachment using the credentials of the
+  teacher that created it.
+
+  Runs on a background thread in its own app context, so everything it needs
+  from the request is passed in. Errors are logged, since there is no request
+  to report them to.
+
+  Args:
+      teacher_id: The ID of the teacher that created the attachment.
+      course_id: The ID of the course.
+      item_id: The ID of the course work item.
+      attachment_id: The ID of the attachment.
+      submission_id: The ID of the student's submission.
+      grade: The number of points the student earned.
+  """
+  with app.app_context():
+    try:
+      # Create an instance of the Classroom service using the refresh
+      # token for the teacher that created the attachment.
+      teacher_classroom_service = (
+          ch._credential_handler.get_classroom_service_for_user(teacher_id)
+      )
+
+      # Build an AddOnAttachmentStudentSubmission instance.
+      add_on_attachment_student_submission = {
+          # Specifies the student's score for this attachment.
+          "pointsEarned": grade,
+      }
+
+      # Issue a PATCH request as the teacher to set the grade numerator
+      # for this attachment.
+      (
+          teacher_classroom_service.courses()
+          .courseWork()
+          .addOnAttachments()
+          .studentSubmissions()
+          .patch(
+              courseId=course_id,
+              itemId=item_id,
+              attachmentId=attachment_id,
+              submissionId=submission_id,
+              # updateMask is a list of fields being modified.
+              updateMask="pointsEarned",
+              body=add_on_attachment_student_submission,
+          )
+          .execute()
+      )
+    except Exception:
+      app.logger.exception(
+          "Failed to pass back the grade for submission %s.", submission_id
+      )
+
+
 def add_iframe_query_parameters_to_session(args):
   """
   Extract the identifiers passed to the iframe as query parameters.
@@ -246,20 +438,10 @@ def add_iframe_query_parameters_to_session(args):
       args: The dictionary of query parameters passed to the iframe.
   """
 
-  if args.get("itemId"):
-    flask.session["itemId"] = args.get("itemId")
-  if args.get("itemType"):
-    flask.session["itemType"] = args.get("itemType")
-  if args.get("courseId"):
-    flask.session["courseId"] = args.get("courseId")
-  if args.get("addOnToken"):
-    flask.session["addOnToken"] = args.get("addOnToken")
-  if args.get("attachmentId"):
-    flask.session["attachmentId"] = args.get("attachmentId")
-  if args.get("submissionId"):
-    flask.session["submissionId"] = args.get("submissionId")
-  if args.get("login_hint"):
-    flask.session["login_hint"] = args.get("login_hint")
+  for parameter in IFRAME_QUERY_PARAMETERS:
+    value = args.get(parameter)
+    if value:
+      flask.session[parameter] = value
 
 
 @app.route("/load-activity-attachment", methods=["GET", "POST"])
@@ -293,8 +475,15 @@ def load_activity_attachment():
       .execute()
   )
 
-  response_strings = [pprint.pformat(addon_context_response)]
+  response_strings = []
   request_strings = []
+  show_api_trace = should_show_api_trace()
+
+  if show_api_trace:
+    response_strings.append(format_for_display(addon_context_response))
+
+  # Whether the student has turned in the work this attachment belongs to.
+  is_turned_in = False
 
   # Determine which view we are in by testing the returned context type.
   user_context = (
@@ -304,20 +493,23 @@ def load_activity_attachment():
   message_str = f"I see that you are a {user_context}! "
 
   # If the user is a teacher, we can fetch information about the attachment.
+  # The page is rendered from the stored attachment, so the attachment is only
+  # fetched when the API trace will show it.
   if user_context == "teacher":
-    attachment_response = (
-        classroom_service.courses()
-        .courseWork()
-        .addOnAttachments()
-        .get(
-            courseId=flask.session["courseId"],
-            itemId=flask.session["itemId"],
-            attachmentId=flask.session["attachmentId"],
-        )
-        .execute()
-    )
+    if show_api_trace:
+      attachment_response = (
+          classroom_service.courses()
+          .courseWork()
+          .addOnAttachments()
+          .get(
+              courseId=flask.session["courseId"],
+              itemId=flask.session["itemId"],
+              attachmentId=flask.session["attachmentId"],
+          )
+          .execute()
+      )
 
-    response_strings.append(pprint.pformat(attachment_response))
+      response_strings.append(format_for_display(attachment_response))
 
     message_str += (
         f"I've loaded the attachment with ID {attachment.attachment_id}."
@@ -330,23 +522,25 @@ def load_activity_attachment():
         "studentContext"
     ).get("submissionId")
 
-    submission_response = (
-        classroom_service.courses()
-        .courseWork()
-        .addOnAttachments()
-        .studentSubmissions()
-        .get(
-            courseId=flask.session["courseId"],
-            itemId=flask.session["itemId"],
-            attachmentId=flask.session["attachmentId"],
-            submissionId=flask.session["submissionId"],
-        )
-        .execute()
+    # The submission state may be a little stale when it's only used for the
+    # message, but a posted response is checked against the current state,
+    # since it can't be recorded once the work has been turned in.
+    submission_response = get_student_submission(
+        classroom_service,
+        flask.session["courseId"],
+        flask.session["itemId"],
+        flask.session["attachmentId"],
+        flask.session["submissionId"],
+        use_cache=flask.request.method != "POST",
     )
 
-    response_strings.append(pprint.pformat(submission_response))
+    if show_api_trace:
+      response_strings.append(format_for_display(submission_response))
 
-    if submission_response.get("postSubmissionState") == "TURNED_IN":
+    is_turned_in = (
+        submission_response.get("postSubmissionState") == "TURNED_IN"
+    )
+    if is_turned_in:
       message_str += "You have already turned in this activity."
     else:
       message_str += "Please complete the activity below."
@@ -354,7 +548,7 @@ def load_activity_attachment():
   # Build the activity form.
   form = activity_form_builder()
 
-  if form.validate_on_submit():
+  if form.validate_on_submit() and not is_turned_in:
     # Check if the student has already submitted a response.
     # If so, update the response stored in the database.
     student_submission = Submission.query.get(
@@ -388,48 +582,19 @@ def load_activity_attachment():
         grade = attachment.max_points
 
       # Only a teacher can set the attachment's grade; since the currently
-      # logged in user is a student, we'll need to retrieve the teacher's
-      # credentials.
-
-      # Create an instance of the Classroom service using the refresh
-      # token for the teacher that created the attachment.
-      teacher_classroom_service = (
-          ch._credential_handler.get_classroom_service_for_user(
-              attachment.teacher_id
-          )
-      )
-
-      # Build an AddOnAttachmentStudentSubmission instance.
-      add_on_attachment_student_submission = {
-          # Specifies the student's score for this attachment.
-          "pointsEarned": grade,
-      }
-
-      request_strings.append(
-          pprint.pformat(add_on_attachment_student_submission)
-      )
-
-      # Issue a PATCH request as the teacher to set the grade numerator
-      # for this attachment.
-      patch_grade_response = (
-          teacher_classroom_service.courses()
-          .courseWork()
-          .addOnAttachments()
-          .studentSubmissions()
-          .patch(
-              courseId=flask.session["courseId"],
-              itemId=flask.session["itemId"],
-              attachmentId=flask.session["attachmentId"],
-              submissionId=flask.session["submissionId"],
-              # updateMask is a list of fields being modified.
-              updateMask="pointsEarned",
-              body=add_on_attachment_student_submission,
-          )
-          .execute()
+      # logged in user is a student, the grade is passed back with the
+      # teacher's stored credentials. This happens in the background, so the
+      # student doesn't wait on the request.
+      _grade_passback_executor.submit(
+          pass_back_grade,
+          attachment.teacher_id,
+          flask.session["courseId"],
+          flask.session["itemId"],
+          flask.session["attachmentId"],
+          flask.session["submissionId"],
+          grade,
       )
 
-      response_strings.append(pprint.pformat(patch_grade_response))
-
     return flask.render_template(
         "acknowledge-submission.html",
         message="Your response has been recorded. You can close the "
@@ -496,16 +661,17 @@ def view_submission():
   # In production, we recommend fully validating the user's authorization at
   # this stage as well.
 
-  # Look up the student's submission in our database.
+  # Look up the student's submission in our database. Its attachment is
+  # loaded by the same query.
   student_submission = Submission.query.get(
       (flask.session["submissionId"], flask.session["attachmentId"])
   )
 
-  # Look up the attachment in the database.
-  attachment = Attachment.query.get(student_submission.attachment_id)
-
   # Show a message if the student has not yet submitted a response.
   if student_submission is None:
+    # Look up the attachment in the database.
+    attachment = Attachment.query.get(flask.session["attachmentId"])
+
     return flask.render_template(
         "acknowledge-submission.html",
         message="This student has not yet submitted a response.",
@@ -513,8 +679,11 @@ def view_submission():
         correct_answer=attachment.image_caption,
     )
 
+  attachment = student_submission.attachment
+
   response_strings = []
   request_strings = []
+  show_api_trace = should_show_api_trace()
 
   if SET_GRADE_WITH_LOGGED_IN_USER_CREDENTIALS:
     # Pass back a grade when opened in the Student Work Review iframe.
@@ -540,7 +709,10 @@ def view_submission():
         "pointsEarned": grade,
     }
 
-    request_strings.append(pprint.pformat(add_on_attachment_student_submission))
+    if show_api_trace:
+      request_strings.append(
+          format_for_display(add_on_attachment_student_submission)
+      )
 
     # Issue a PATCH request to set the grade numerator for this attachment.
     patch_grade_response = (
@@ -560,7 +732,8 @@ def view_submission():
         .execute()
     )
 
-    response_strings.append(pprint.pformat(patch_grade_response))
+    if show_api_trace:
+      response_strings.append(format_for_display(patch_grade_response))
 
   # Render the student's response alongside the correct answer.
   return flask.render_template(
@@ -14,22 +14,36 @@
 # the License.
 """Provides the CredentialHandler object to manage OAuth credentials."""
 
-from copy import deepcopy
 from webapp.models import User
 from webapp import app, db
-import json
+import cachetools
 import flask
+import orjson
 import os
+import pathlib
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+from urllib3.util.retry import Retry
 
 import google.oauth2.credentials
+import google_auth_httplib2
 import google_auth_oauthlib.flow
 import googleapiclient.discovery
+import googleapiclient.discovery_cache
+import googleapiclient.http
 from google.auth.transport.requests import Request
 
 # This variable specifies the name of a file that contains the OAuth 2.0
 # information for this application, including its client_id and client_secret.
 CLIENT_SECRETS_FILE = "client_secret.json"
 
+# The "web" section of the client secrets file, parsed once when the module is
+# loaded rather than on every request that needs it.
+_CLIENT_SECRETS = orjson.loads(
+    pathlib.Path(CLIENT_SECRETS_FILE).read_bytes()
+)["web"]
+
 # This OAuth 2.0 access scope allows for full read/write access to the
 # authenticated user's account and requires requests to use an SSL connection.
 # These scopes should match the scopes in your GCP project's
@@ -54,6 +68,35 @@ CLASSROOM_API_VERSION = "v1"
 # https://console.cloud.google.com/apis/credentials.
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 
+# A Google API Key can be created in your GCP project's Credentials
+# settings: https://console.cloud.google.com/apis/credentials.
+# Click "Create Credentials" at top and choose "API key", then provide
+# the key in the URL below.
+CLASSROOM_DISCOVERY_URL = f"https://classroom.googleapis.com/$discovery/rest?labels=ADD_ONS_ALPHA&key={GOOGLE_API_KEY}"
+
+# How long a fetched discovery document is reused before it's fetched again,
+# so that changes to the API surface are eventually picked up.
+DISCOVERY_DOCUMENT_TTL_SECONDS = 60 * 60
+
+# A shared HTTP session for requests made directly to Google's OAuth and
+# discovery endpoints, so that they reuse pooled connections.
+_http_session = requests.Session()
+_http_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.1),
+    ),
+)
+
+# The httplib2 connection used by API clients built on each thread. httplib2
+# isn't thread-safe, so threads can't share one. Every API call a request
+# makes reuses its thread's connection to googleapis.com, as do successive
+# grade passbacks on the same background thread. The development server
+# starts a new thread per request, so it isn't reused across requests there.
+_thread_local = threading.local()
+
 
 class CredentialHandler:
   """Provides the CredentialHandler object to manage OAuth credentials."""
@@ -64,7 +107,11 @@ class CredentialHandler:
     Args:
         client_secrets_file: The path to the client secrets file.
     """
-    self._client_secrets_dict = json.load(open(client_secrets_file)).get("web")
+    self._client_secrets_dict = (
+        _CLIENT_SECRETS
+        if client_secrets_file == CLIENT_SECRETS_FILE
+        else orjson.loads(pathlib.Path(client_secrets_file).read_bytes())["web"]
+    )
     self._credentials = None
 
   def get_credentials(self, user_id=None):
@@ -112,9 +159,6 @@ class CredentialHandler:
 
     # If we have stored credentials, load them into the session.
     if stored_credentials:
-      # Load the client secrets file contents.
-      client_secrets_dict = json.load(open(CLIENT_SECRETS_FILE)).get("web")
-
       # Update the credentials in the session.
       if not flask.session.get("credentials"):
         flask.session["credentials"] = {}
@@ -125,13 +169,9 @@ class CredentialHandler:
       flask.session["credentials"][
           "refresh_token"
       ] = stored_credentials.refresh_token
-      flask.session["credentials"]["token_uri"] = client_secrets_dict[
-          "token_uri"
-      ]
-      flask.session["credentials"]["client_id"] = client_secrets_dict[
-          "client_id"
-      ]
-      flask.session["credentials"]["client_secret"] = client_secrets_dict[
+      flask.session["credentials"]["token_uri"] = _CLIENT_SECRETS["token_uri"]
+      flask.session["credentials"]["client_id"] = _CLIENT_SECRETS["client_id"]
+      flask.session["credentials"]["client_secret"] = _CLIENT_SECRETS[
           "client_secret"
       ]
       flask.session["credentials"]["scopes"] = SCOPES
@@ -151,8 +191,9 @@ class CredentialHandler:
     """
 
     # Issue a request for the user's profile details.
-    user_info_service = googleapiclient.discovery.build(
-        serviceName="oauth2", version="v2", credentials=credentials
+    user_info_service = googleapiclient.discovery.build_from_document(
+        get_discovery_document("oauth2", "v2"),
+        http=authorize_http(credentials),
     )
     user_info = user_info_service.userinfo().get().execute()
     flask.session["username"] = user_info.get("name")
@@ -195,30 +236,16 @@ class CredentialHandler:
     Returns:
         The Google Classroom discovery service.
     """
-    return (
-        googleapiclient.discovery.build(
-            serviceName=service_name,
-            version=version,
-            credentials=self.get_credentials(),
-        )
-        if service_url is None
-        else googleapiclient.discovery.build(
-            serviceName=service_name,
-            version=version,
-            discoveryServiceUrl=service_url,
-            credentials=self.get_credentials(),
-        )
+    return googleapiclient.discovery.build_from_document(
+        get_discovery_document(service_name, version, service_url),
+        http=authorize_http(self.get_credentials()),
     )
 
   def get_classroom_service(self):
-    # A Google API Key can be created in your GCP project's Credentials
-    # settings: https://console.cloud.google.com/apis/credentials.
-    # Click "Create Credentials" at top and choose "API key", then provide
-    # the key in the service_url below.
     return self.get_discovery_service(
         CLASSROOM_API_SERVICE_NAME,
         CLASSROOM_API_VERSION,
-        service_url=f"https://classroom.googleapis.com/$discovery/rest?labels=ADD_ONS_ALPHA&key={GOOGLE_API_KEY}",
+        service_url=CLASSROOM_DISCOVERY_URL,
     )
 
   def get_classroom_service_for_user(self, user_id):
@@ -227,7 +254,8 @@ class CredentialHandler:
     for a specific user.
 
     Note that this method assumes that the specified user has already been
-    granted access to the Classroom API.
+    granted access to the Classroom API. It doesn't read the session, so it
+    can also be called outside of a request.
 
     Args:
         user_id: The user ID that should be granted access to the service.
@@ -236,42 +264,30 @@ class CredentialHandler:
         credentials.
     """
 
-    # We're assuming that there are already credentials in the session.
-    # These will be valid to construct a Classroom service for another user
-    # except for the tokens.
-    if not flask.session.get("credentials"):
-      raise ValueError(
-          "No credentials found in session for the requested user."
-      )
-
-    # Make a copy of the credentials, so we don't modify the original.
-    user_credentials_dict = deepcopy(flask.session.get("credentials"))
-
     # Retrieve the requested user's stored record.
     user_record = User.query.get(user_id)
 
-    # Apply the user's tokens to the copied credentials.
-    user_credentials_dict["refresh_token"] = user_record.refresh_token
-    user_credentials_dict["token"] = user_record.access_token
-
-    # Construct a temporary credentials object.
+    # Construct a temporary credentials object from the user's tokens and the
+    # app's client secrets.
     user_credentials = google.oauth2.credentials.Credentials(
-        **user_credentials_dict
+        token=user_record.access_token,
+        refresh_token=user_record.refresh_token,
+        token_uri=_CLIENT_SECRETS["token_uri"],
+        client_id=_CLIENT_SECRETS["client_id"],
+        client_secret=_CLIENT_SECRETS["client_secret"],
+        scopes=SCOPES,
     )
     if user_credentials.expired:
-      user_credentials.refresh(Request())
+      user_credentials.refresh(Request(session=_http_session))
 
     # Request the Classroom service for the specified user.
-
-    # A Google API Key can be created in your GCP project's Credentials
-    # settings: https://console.cloud.google.com/apis/credentials.
-    # Click "Create Credentials" at top and choose "API key", then provide
-    # the key in the discoveryServiceUrl below.
-    return googleapiclient.discovery.build(
-        serviceName=CLASSROOM_API_SERVICE_NAME,
-        version=CLASSROOM_API_VERSION,
-        discoveryServiceUrl=f"https://classroom.googleapis.com/$discovery/rest?labels=ADD_ONS_ALPHA&key={GOOGLE_API_KEY}",
-        credentials=user_credentials,
+    return googleapiclient.discovery.build_from_document(
+        get_discovery_document(
+            CLASSROOM_API_SERVICE_NAME,
+            CLASSROOM_API_VERSION,
+            CLASSROOM_DISCOVERY_URL,
+        ),
+        http=authorize_http(user_credentials),
     )
 
   def clear_credentials_in_session(self):
@@ -287,6 +303,73 @@ class CredentialHandler:
 _credential_handler = CredentialHandler()
 
 
+@cachetools.cached(
+    cachetools.TTLCache(maxsize=16, ttl=DISCOVERY_DOCUMENT_TTL_SECONDS),
+    lock=threading.Lock(),
+)
+def get_discovery_document(service_name, version, service_url=None):
+  """Gets the discovery document for an API, caching it for an hour.
+
+  Building a service from a cached document avoids downloading and parsing
+  the document every time a service is requested. Services are still built
+  per request, so each one carries the caller's credentials.
+
+  Args:
+      service_name: The name of the API.
+      version: The version of the API.
+      service_url: Optional URL to fetch the document from. If not provided,
+          the document bundled with the client library is used.
+
+  Returns:
+      The parsed discovery document.
+  """
+  if service_url is None:
+    return orjson.loads(
+        googleapiclient.discovery_cache.get_static_doc(service_name, version)
+    )
+
+  response = _http_session.get(service_url)
+  response.raise_for_status()
+  return orjson.loads(response.content)
+
+
+def authorize_http(credentials):
+  """Authorizes this thread's reusable httplib2 connection.
+
+  Args:
+      credentials: The OAuth credentials to send with each request.
+
+  Returns:
+      An AuthorizedHttp to pass to a service as its http object.
+  """
+  http = getattr(_thread_local, "http", None)
+  if http is None:
+    http = _thread_local.http = googleapiclient.http.build_http()
+
+  return google_auth_httplib2.AuthorizedHttp(credentials, http=http)
+
+
+def prefetch_classroom_discovery_document():
+  """Fetches the Classroom discovery document ahead of the first request."""
+  try:
+    get_discovery_document(
+        CLASSROOM_API_SERVICE_NAME,
+        CLASSROOM_API_VERSION,
+        CLASSROOM_DISCOVERY_URL,
+    )
+  except requests.RequestException:
+    # The first request that needs the document will fetch it instead.
+    app.logger.warning(
+        "Couldn't prefetch the Classroom discovery document.", exc_info=True
+    )
+
+
+# Fetch the document in the background so that it doesn't delay startup.
+threading.Thread(
+    target=prefetch_classroom_discovery_document, daemon=True
+).start()
+
+
 @app.route("/start-auth-flow/<redirect_destination>")
 def start_auth_flow(redirect_destination):
   """
@@ -308,8 +391,8 @@ def build_flow_instance(redirect_uri, state=None):
   Returns:
       A Google OAuth 2.0 authorization flow instance.
   """
-  return google_auth_oauthlib.flow.Flow.from_client_secrets_file(
-      CLIENT_SECRETS_FILE,
+  return google_auth_oauthlib.flow.Flow.from_client_config(
+      {"web": _CLIENT_SECRETS},
       scopes=SCOPES,
       state=state,
       redirect_uri=flask.url_for(redirect_uri, _external=True),
@@ -19,6 +19,17 @@ Uses the flask-sqlalchemy database object defined in the webapp module."""
 from webapp import db
 
 
+def redact_token(token):
+  """Shortens a token to its last four characters for logs and reprs.
+
+  Args:
+      token: An OAuth token, or None.
+  Returns:
+      The redacted token, or None if there is no token.
+  """
+  return f"...{token[-4:]}" if token else None
+
+
 # Database model to represent a user.
 class User(db.Model):
   # The user's identifying information:
@@ -39,10 +50,9 @@ class User(db.Model):
 
   def __repr__(self):
     return (
-        f"<User {self.display_name}, ID {self.id}, "
-        f"name {self.display_name}, email {self.email}, "
-        f"port {self.portrait_url}, ref {self.refresh_token}>"
-        f"access {self.access_token}>"
+        f"<User {self.display_name}, ID {self.id}, email {self.email}, "
+        f"port {self.portrait_url}, ref {redact_token(self.refresh_token)}, "
+        f"access {redact_token(self.access_token)}>"
     )
 
 
@@ -70,7 +80,15 @@ class Submission(db.Model):
   submission_id = db.Column(db.String(120), primary_key=True)
 
   # The unique identifier for the student's submission.
-  attachment_id = db.Column(db.String(120), primary_key=True)
+  attachment_id = db.Column(
+      db.String(120),
+      db.ForeignKey("attachment.attachment_id"),
+      primary_key=True,
+  )
+
+  # The attachment that this submission responds to, loaded with a join
+  # whenever the submission is loaded.
+  attachment = db.relationship("Attachment", lazy="joined")
 
   # The student's response to the question prompt.
   student_response = db.Column(db.String(120))
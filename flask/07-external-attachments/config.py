@@ -39,3 +39,7 @@ class Config(object):
   # Point to a database file in the project root.
   SQLALCHEMY_DATABASE_URI = f"sqlite:///{DATABASE_FILE_NAME}"
   SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+  # Show the Classroom API requests and responses on each page. This is always
+  # enabled when the server runs in debug mode.
+  SHOW_API_TRACE = bool(os.environ.get("SHOW_API_TRACE"))
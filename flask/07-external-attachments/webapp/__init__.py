@@ -32,6 +32,10 @@ from webapp import coursework_routes
 from webapp import models
 from webapp import credential_handler as ch
 
+# Load every template once at startup instead of on its first request.
+for template_name in app.jinja_env.list_templates():
+  app.jinja_env.get_template(template_name)
+
 # Initialize the database file if not created.
 if not path.exists(config.DATABASE_FILE_NAME):
   db.create_all()
@@ -20,7 +20,6 @@ from webapp import credential_handler as ch
 import json
 import flask
 import pprint
-import requests
 
 import google.oauth2.credentials
 import googleapiclient.discovery
@@ -120,8 +119,9 @@ def test_api_request(request_type="username"):
   fetched_data = ""
 
   if request_type == "username":
-    user_info_service = googleapiclient.discovery.build(
-        serviceName="oauth2", version="v2", credentials=credentials
+    user_info_service = googleapiclient.discovery.build_from_document(
+        ch.get_discovery_document("oauth2", "v2"),
+        http=ch.authorize_http(credentials),
     )
 
     flask.session["username"] = user_info_service.userinfo().get().execute().get("name")
@@ -192,7 +192,7 @@ def revoke():
 
   credentials = google.oauth2.credentials.Credentials(**flask.session["credentials"])
 
-  revoke = requests.post(
+  revoke_response = ch._http_session.post(
       "https://oauth2.googleapis.com/revoke",
       params={"token": credentials.token},
       headers={"content-type": "application/x-www-form-urlencoded"},
@@ -200,8 +200,7 @@ def revoke():
 
   ch._credential_handler.clear_credentials_in_session()
 
-  status_code = getattr(revoke, "status_code")
-  if status_code == 200:
+  if revoke_response.status_code == 200:
     return ch.start_auth_flow("discovery_callback")
   else:
     return flask.render_template(
@@ -17,8 +17,119 @@
 from webapp import app
 from webapp import credential_handler as ch
 
+import cachetools
 import flask
-import pprint
+import functools
+import json
+import orjson
+import threading
+
+# The titles of recently modified CourseWork assignments, keyed by user,
+# course and assignment ID. Each PATCH response carries the assignment's new
+# title, so the same user modifying the assignment again within a few minutes
+# can skip fetching it first. The user is part of the key so that a title is
+# only returned to a user whose own request read it.
+_coursework_title_cache = cachetools.TTLCache(maxsize=1024, ttl=300)
+_coursework_title_cache_lock = threading.Lock()
+
+# Recent checkAddOnCreationEligibility responses, keyed by user and course
+# ID. A user's eligibility in a course rarely changes, so the check is made at
+# most once every few minutes.
+_eligibility_cache = cachetools.TTLCache(maxsize=1024, ttl=300)
+_eligibility_cache_lock = threading.Lock()
+
+# The prefix modify_coursework_assignment adds to an assignment's title.
+MODIFIED_TITLE_PREFIX = "(Modified by API request) "
+
+# The fields shared by every CourseWork assignment created by
+# create_coursework_assignment. Request bodies are built on top of these.
+COURSEWORK_LINK_MATERIAL_BASE = {
+    "title": "My CourseWork Assignment with Link Material",
+    "description": "Created using the Classroom CourseWork API.",
+    "workType": "ASSIGNMENT",
+    "state": "DRAFT",  # Set to 'PUBLISHED' to assign to students.
+}
+COURSEWORK_ADD_ON_ATTACHMENT_BASE = {
+    "title": "My CourseWork Assignment with Add-on Attachment",
+    "description": "Created using the Classroom CourseWork API.",
+    "workType": "ASSIGNMENT",
+    "state": "DRAFT",  # Set to 'PUBLISHED' to assign to students.
+}
+
+
+def should_show_api_trace():
+  """Reports whether API requests and responses should be shown on pages.
+
+  Returns:
+      True if the app is running in debug mode or SHOW_API_TRACE is set.
+  """
+  return app.debug or app.config["SHOW_API_TRACE"]
+
+
+def format_for_display(value):
+  """Formats an API request or response body for display on a page.
+
+  The JSON is only indented when the server runs in debug mode; otherwise it's
+  written compactly.
+
+  Args:
+      value: A JSON-compatible value, such as a dictionary.
+  Returns:
+      The value as JSON with sorted keys.
+  """
+  pretty = app.debug
+
+  try:
+    option = orjson.OPT_SORT_KEYS
+    if pretty:
+      option |= orjson.OPT_INDENT_2
+    return orjson.dumps(value, option=option).decode()
+  except TypeError:
+    # orjson rejects some values, such as integers wider than 64 bits, that
+    # the standard library can still serialize.
+    if pretty:
+      return json.dumps(value, indent=2, sort_keys=True, default=str)
+    return json.dumps(
+        value, separators=(",", ":"), sort_keys=True, default=str
+    )
+
+
+class LazyFormat(object):
+  """Formats an API request or response body only when it's displayed.
+
+  The formatted text is built when the template converts the value to a
+  string, so bodies that a page doesn't display are never formatted.
+  """
+
+  __slots__ = ("value",)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __str__(self):
+    return format_for_display(self.value)
+
+
+@functools.lru_cache(maxsize=16)
+def get_example_coursework_assignment_url(url_root, assignment_type):
+  """Builds the external URL of the example content for an assignment type.
+
+  Building an external URL matches the route against the app's URL map, so
+  the result is cached. The URL only changes with the host the request was
+  made to, which is why the request's URL root is part of the cache key.
+
+  Args:
+      url_root: The root URL of the current request.
+      assignment_type: The assignment type shown by the example content.
+  Returns:
+      The HTTPS URL of the example content.
+  """
+  return flask.url_for(
+      "example_coursework_assignment",
+      assignment_type=assignment_type,
+      _scheme="https",
+      _external=True,
+  )
 
 
 @app.route("/create-coursework-assignment")
@@ -36,11 +147,15 @@ def create_coursework_assignment():
   if not credentials:
     return ch.start_auth_flow("coursework_assignment_callback")
 
-  # Get the Google Classroom service.
+  # Get the Google Classroom service, and the resources the requests below are
+  # made through.
   classroom_service = ch._credential_handler.get_classroom_service()
+  courses_resource = classroom_service.courses()
+  coursework_resource = courses_resource.courseWork()
 
   request_strings = []
   response_strings = []
+  show_api_trace = should_show_api_trace()
   assignment_type = ""
 
   # The ID of the course to which the assignment will be added.
@@ -48,33 +163,39 @@ def create_coursework_assignment():
   # we use a hard-coded value in this example.
   course_id = 1234567890  # TODO(developer) Replace with an actual course ID.
 
-  # Check whether the user can create add-on attachments.
-  eligibility_response = (
-      classroom_service.courses()
-      .checkAddOnCreationEligibility(courseId=course_id)
-      .execute()
-  )
-  is_create_attachment_eligible = eligibility_response.get("isCreateAttachmentEligible")
+  # Check whether the user can create add-on attachments, unless the user was
+  # checked in this course recently.
+  eligibility_key = (flask.session.get("login_hint"), course_id)
+  with _eligibility_cache_lock:
+    eligibility_response = _eligibility_cache.get(eligibility_key)
+
+  if eligibility_response is None:
+    eligibility_response = (
+        courses_resource.checkAddOnCreationEligibility(courseId=course_id)
+        .execute()
+    )
+
+    # Only cache the response if we know whose eligibility it describes.
+    if eligibility_key[0] is not None:
+      with _eligibility_cache_lock:
+        _eligibility_cache[eligibility_key] = eligibility_response
 
-  request_strings.append(f"checkAddOnCreationEligibility courseId:{course_id}")
-  response_strings.append(pprint.pformat(eligibility_response))
+    if show_api_trace:
+      request_strings.append(f"checkAddOnCreationEligibility courseId:{course_id}")
+      response_strings.append(LazyFormat(eligibility_response))
+
+  is_create_attachment_eligible = eligibility_response.get("isCreateAttachmentEligible")
 
   # If the user can't create add-on attachments, create a CourseWork assignment with the
   # URL to the selected content as a Link Material.
   if not is_create_attachment_eligible:
     coursework = {
-        "title": "My CourseWork Assignment with Link Material",
-        "description": "Created using the Classroom CourseWork API.",
-        "workType": "ASSIGNMENT",
-        "state": "DRAFT",  # Set to 'PUBLISHED' to assign to students.
+        **COURSEWORK_LINK_MATERIAL_BASE,
         "materials": [
             {
                 "link": {
-                    "url": flask.url_for(
-                        "example_coursework_assignment",
-                        assignment_type="link-material",
-                        _scheme="https",
-                        _external=True,
+                    "url": get_example_coursework_assignment_url(
+                        flask.request.url_root, "link-material"
                     )
                 }
             }
@@ -82,43 +203,33 @@ def create_coursework_assignment():
     }
 
     assignment_response = (
-        classroom_service.courses()
-        .courseWork()
-        .create(courseId=course_id, body=coursework)
+        coursework_resource.create(courseId=course_id, body=coursework)
         .execute()
     )
 
-    request_strings.append(pprint.pformat(coursework))
-    response_strings.append(pprint.pformat(assignment_response))
+    if show_api_trace:
+      request_strings.append(LazyFormat(coursework))
+      response_strings.append(LazyFormat(assignment_response))
     assignment_type = "link-material"
 
   else:
     # If the user can create add-on attachments, do the following:
     # Create an assignment.
-    coursework = {
-        "title": "My CourseWork Assignment with Add-on Attachment",
-        "description": "Created using the Classroom CourseWork API.",
-        "workType": "ASSIGNMENT",
-        "state": "DRAFT",  # Set to 'PUBLISHED' to assign to students.
-    }
+    coursework = dict(COURSEWORK_ADD_ON_ATTACHMENT_BASE)
 
     assignment_response = (
-        classroom_service.courses()
-        .courseWork()
-        .create(courseId=course_id, body=coursework)
+        coursework_resource.create(courseId=course_id, body=coursework)
         .execute()
     )
 
-    request_strings.append(pprint.pformat(coursework))
-    response_strings.append(pprint.pformat(assignment_response))
+    if show_api_trace:
+      request_strings.append(LazyFormat(coursework))
+      response_strings.append(LazyFormat(assignment_response))
 
     # Create an add-on attachment that links to the selected content and associate it
     # with the new assignment.
-    content_url = flask.url_for(
-        "example_coursework_assignment",
-        assignment_type="add-on-attachment",
-        _scheme="https",
-        _external=True,
+    content_url = get_example_coursework_assignment_url(
+        flask.request.url_root, "add-on-attachment"
     )
     attachment = {
         "teacherViewUri": {"uri": content_url},
@@ -127,9 +238,7 @@ def create_coursework_assignment():
     }
 
     add_on_attachment_response = (
-        classroom_service.courses()
-        .courseWork()
-        .addOnAttachments()
+        coursework_resource.addOnAttachments()
         .create(
             courseId=course_id,
             itemId=assignment_response.get("id"),  # ID of the new assignment.
@@ -138,17 +247,22 @@ def create_coursework_assignment():
         .execute()
     )
 
-    request_strings.append(pprint.pformat(attachment))
-    response_strings.append(pprint.pformat(add_on_attachment_response))
+    if show_api_trace:
+      request_strings.append(LazyFormat(attachment))
+      response_strings.append(LazyFormat(add_on_attachment_response))
 
     assignment_type = "add-on attachment"
 
   # Inform the teacher that the assignment has been created successfully.
-  return flask.render_template(
-      "coursework-assignment-created.html",
-      assignment_type=assignment_type,
-      request_strings=request_strings,
-      response_strings=response_strings,
+  # Stream the page so that it starts being sent while the request and
+  # response bodies, when shown, are still being formatted.
+  return app.response_class(
+      flask.stream_template(
+          "coursework-assignment-created.html",
+          assignment_type=assignment_type,
+          requests=request_strings,
+          responses=response_strings,
+      )
   )
 
 
@@ -164,10 +278,13 @@ def modify_coursework_assignment():
   if not credentials:
     return ch.start_auth_flow("coursework_assignment_callback")
 
-  # Get the Google Classroom service.
+  # Get the Google Classroom service, and the resource the requests below are
+  # made through.
   classroom_service = ch._credential_handler.get_classroom_service()
+  coursework_resource = classroom_service.courses().courseWork()
 
   response_strings = []
+  show_api_trace = should_show_api_trace()
 
   # The ID of the course to which the assignment will be added.
   # Ordinarily, you'll prompt the user to specify which course to use. For simplicity,
@@ -175,19 +292,37 @@ def modify_coursework_assignment():
   course_id = 1234567890  # TODO(developer) Replace with an actual course ID.
   coursework_id = 1234567890  # TODO(developer) Replace with an actual assignment ID.
 
-  get_coursework_response = (
-      classroom_service.courses()
-      .courseWork()
-      .get(courseId=course_id, id=coursework_id)
-      .execute()
-  )
+  # Look up the assignment's current title, unless a recent modification by
+  # the same user already returned it.
+  title_key = (flask.session.get("login_hint"), course_id, coursework_id)
+  with _coursework_title_cache_lock:
+    current_title = _coursework_title_cache.get(title_key)
+
+  if current_title is None:
+    get_coursework_response = (
+        coursework_resource.get(courseId=course_id, id=coursework_id)
+        .execute()
+    )
+    current_title = get_coursework_response.get("title")
+
+    if show_api_trace:
+      response_strings.append(LazyFormat(get_coursework_response))
+
+  # If the assignment has already been modified, there's nothing to change, so
+  # skip the PATCH rather than stacking another prefix onto the title.
+  if current_title is not None and current_title.startswith(
+      MODIFIED_TITLE_PREFIX
+  ):
+    return flask.render_template(
+        "coursework-modified.html",
+        assignment_title=current_title,
+        responses=response_strings,
+    )
 
-  assignment_title = f"(Modified by API request) {get_coursework_response.get('title')}"
+  assignment_title = f"{MODIFIED_TITLE_PREFIX}{current_title}"
 
   modify_coursework_response = (
-      classroom_service.courses()
-      .courseWork()
-      .patch(
+      coursework_resource.patch(
           courseId=course_id,
           id=coursework_id,
           updateMask="title",
@@ -196,13 +331,20 @@ def modify_coursework_assignment():
       .execute()
   )
 
-  response_strings.append(pprint.pformat(get_coursework_response))
-  response_strings.append(pprint.pformat(modify_coursework_response))
+  if show_api_trace:
+    response_strings.append(LazyFormat(modify_coursework_response))
+
+  # Only cache the title if we know which user it was returned to.
+  if title_key[0] is not None:
+    with _coursework_title_cache_lock:
+      _coursework_title_cache[title_key] = modify_coursework_response.get(
+          "title"
+      )
 
   return flask.render_template(
       "coursework-modified.html",
       assignment_title=modify_coursework_response.get("title"),
-      response_strings=response_strings,
+      responses=response_strings,
   )
 
 
@@ -16,13 +16,21 @@
 
 from webapp.models import User
 from webapp import app, db
+import cachetools
 import json
 import flask
 import os
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+from urllib3.util.retry import Retry
 
 import google.oauth2.credentials
+import google_auth_httplib2
 import google_auth_oauthlib.flow
 import googleapiclient.discovery
+import googleapiclient.discovery_cache
+import googleapiclient.http
 
 # This variable specifies the name of a file that contains the OAuth 2.0
 # information for this application, including its client_id and client_secret.
@@ -48,6 +56,35 @@ CLASSROOM_API_VERSION = "v1"
 # https://console.cloud.google.com/apis/credentials.
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 
+# A Google API Key can be created in your GCP project's Credentials
+# settings: https://console.cloud.google.com/apis/credentials.
+# Click "Create Credentials" at top and choose "API key", then provide
+# the key in the URL below.
+CLASSROOM_DISCOVERY_URL = f"https://classroom.googleapis.com/$discovery/rest?labels=ADD_ONS_ALPHA&key={GOOGLE_API_KEY}"
+
+# How long a fetched discovery document is reused before it's fetched again,
+# so that changes to the API surface are eventually picked up.
+DISCOVERY_DOCUMENT_TTL_SECONDS = 60 * 60
+
+# A shared HTTP session for requests made directly to Google's OAuth and
+# discovery endpoints, so that they reuse pooled connections.
+_http_session = requests.Session()
+_http_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.1),
+    ),
+)
+
+# The httplib2 connection used by API clients built on each thread. httplib2
+# isn't thread-safe, so threads can't share one. Every API call a request
+# makes reuses its thread's connection to googleapis.com. The development
+# server starts a new thread per request, so it isn't reused across requests
+# there.
+_thread_local = threading.local()
+
 
 class CredentialHandler:
   """Provides the CredentialHandler object to manage OAuth credentials."""
@@ -152,8 +189,9 @@ class CredentialHandler:
     """
 
     # Issue a request for the user's profile details.
-    user_info_service = googleapiclient.discovery.build(
-        serviceName="oauth2", version="v2", credentials=credentials
+    user_info_service = googleapiclient.discovery.build_from_document(
+        get_discovery_document("oauth2", "v2"),
+        http=authorize_http(credentials),
     )
     user_info = user_info_service.userinfo().get().execute()
     flask.session["username"] = user_info.get("name")
@@ -195,30 +233,16 @@ class CredentialHandler:
     Returns:
         The Google Classroom discovery service.
     """
-    return (
-        googleapiclient.discovery.build(
-            serviceName=service_name,
-            version=version,
-            credentials=self.get_credentials(),
-        )
-        if service_url is None
-        else googleapiclient.discovery.build(
-            serviceName=service_name,
-            version=version,
-            discoveryServiceUrl=service_url,
-            credentials=self.get_credentials(),
-        )
+    return googleapiclient.discovery.build_from_document(
+        get_discovery_document(service_name, version, service_url),
+        http=authorize_http(self.get_credentials()),
     )
 
   def get_classroom_service(self):
-    # A Google API Key can be created in your GCP project's Credentials
-    # settings: https://console.cloud.google.com/apis/credentials.
-    # Click "Create Credentials" at top and choose "API key", then provide
-    # the key in the discoveryServiceUrl below.
     return self.get_discovery_service(
         CLASSROOM_API_SERVICE_NAME,
         CLASSROOM_API_VERSION,
-        service_url=f"https://classroom.googleapis.com/$discovery/rest?labels=ADD_ONS_ALPHA&key={GOOGLE_API_KEY}",
+        service_url=CLASSROOM_DISCOVERY_URL,
     )
 
   def clear_credentials_in_session(self):
@@ -234,6 +258,73 @@ class CredentialHandler:
 _credential_handler = CredentialHandler()
 
 
+@cachetools.cached(
+    cachetools.TTLCache(maxsize=16, ttl=DISCOVERY_DOCUMENT_TTL_SECONDS),
+    lock=threading.Lock(),
+)
+def get_discovery_document(service_name, version, service_url=None):
+  """Gets the discovery document for an API, caching it for an hour.
+
+  Building a service from a cached document avoids downloading and parsing
+  the document every time a service is requested. Services are still built
+  per request, so each one carries the caller's credentials.
+
+  Args:
+      service_name: The name of the API.
+      version: The version of the API.
+      service_url: Optional URL to fetch the document from. If not provided,
+          the document bundled with the client library is used.
+
+  Returns:
+      The parsed discovery document.
+  """
+  if service_url is None:
+    return json.loads(
+        googleapiclient.discovery_cache.get_static_doc(service_name, version)
+    )
+
+  response = _http_session.get(service_url)
+  response.raise_for_status()
+  return response.json()
+
+
+def authorize_http(credentials):
+  """Authorizes this thread's reusable httplib2 connection.
+
+  Args:
+      credentials: The OAuth credentials to send with each request.
+
+  Returns:
+      An AuthorizedHttp to pass to a service as its http object.
+  """
+  http = getattr(_thread_local, "http", None)
+  if http is None:
+    http = _thread_local.http = googleapiclient.http.build_http()
+
+  return google_auth_httplib2.AuthorizedHttp(credentials, http=http)
+
+
+def prefetch_classroom_discovery_document():
+  """Fetches the Classroom discovery document ahead of the first request."""
+  try:
+    get_discovery_document(
+        CLASSROOM_API_SERVICE_NAME,
+        CLASSROOM_API_VERSION,
+        CLASSROOM_DISCOVERY_URL,
+    )
+  except requests.RequestException:
+    # The first request that needs the document will fetch it instead.
+    app.logger.warning(
+        "Couldn't prefetch the Classroom discovery document.", exc_info=True
+    )
+
+
+# Fetch the document in the background so that it doesn't delay startup.
+threading.Thread(
+    target=prefetch_classroom_discovery_document, daemon=True
+).start()
+
+
 @app.route("/start-auth-flow/<redirect_destination>")
 def start_auth_flow(redirect_destination):
   """
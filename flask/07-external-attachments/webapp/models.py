@@ -19,6 +19,17 @@ Uses the flask-sqlalchemy database object defined in the webapp module."""
 from webapp import db
 
 
+def redact_token(token):
+  """Shortens a token to its last four characters for logs and reprs.
+
+  Args:
+      token: An OAuth token, or None.
+  Returns:
+      The redacted token, or None if there is no token.
+  """
+  return f"...{token[-4:]}" if token else None
+
+
 # Database model to represent a user.
 class User(db.Model):
   # The user's identifying information:
@@ -38,9 +49,8 @@ class User(db.Model):
 
   def __repr__(self):
     return (
-        f"<User {self.display_name}, ID {self.id}, "
-        f"name {self.display_name}, email {self.email}, "
-        f"port {self.portrait_url}, ref {self.refresh_token}>"
+        f"<User {self.display_name}, ID {self.id}, email {self.email}, "
+        f"port {self.portrait_url}, ref {redact_token(self.refresh_token)}>"
     )
 
 